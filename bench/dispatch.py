@@ -0,0 +1,90 @@
+"""
+比较两种把请求参数绑定到处理函数的方式，不需要启动服务器：
+  legacy: 每个请求解析query_string（parse_qs）、复制kw字典、逐个检查必需参数（原来的RequestHandler路径）
+  binder: 注册路由时生成的绑定函数，直接从request.query和match_info取值并按注解转换类型
+运行: python bench/dispatch.py [次数]
+"""
+import os
+import sys
+import timeit
+from urllib import parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "web"))
+
+from coroweb import compile_binder, get_named_kw_args, get_required_kw_args, has_named_kw_args, \
+    has_var_kw_args, hav_request_arg  # noqa: E402
+from handlers import api_blogs, index, manage_blogs  # noqa: E402
+
+
+class FakeRequest(object):
+    """每次计时调用都新建，query和aiohttp一样在第一次访问时解析query_string"""
+    method = "GET"
+
+    def __init__(self, query_string, match_info=None):
+        self.query_string = query_string
+        self.match_info = match_info or {}
+
+    @property
+    def query(self):
+        return dict(parse.parse_qsl(self.query_string, True))
+
+
+def legacy_bind(fn):
+    named = get_named_kw_args(fn)
+    required = get_required_kw_args(fn)
+    has_named = has_named_kw_args(fn)
+    has_request = hav_request_arg(fn)
+    has_var_kw = has_var_kw_args(fn)
+
+    def bind(request):
+        kw = None
+        if has_var_kw or has_named or required:
+            qs = request.query_string
+            if qs:
+                kw = {}
+                for k, v in parse.parse_qs(qs, True).items():
+                    kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not has_var_kw and named:
+                kw = {name: kw[name] for name in named if name in kw}
+            for k, v in request.match_info.items():
+                kw[k] = v
+        if has_request:
+            kw["request"] = request
+        for name in required:
+            if name not in kw:
+                raise ValueError(name)
+        return kw
+
+    return bind
+
+
+def bench(fn, path, query_string, match_info, number):
+    legacy = legacy_bind(fn)
+    binder, _ = compile_binder(fn, path)
+
+    def by_legacy():
+        return legacy(FakeRequest(query_string, match_info))
+
+    def by_binder():
+        # 和RequestHandler一样，有查询参数时才解析
+        request = FakeRequest(query_string, match_info)
+        return binder(request, request.query if request.query_string else None)
+
+    t_legacy = min(timeit.repeat(by_legacy, number=number, repeat=5)) / number * 1e9
+    t_binder = min(timeit.repeat(by_binder, number=number, repeat=5)) / number * 1e9
+    print(f"{fn.__name__:<14} legacy: {t_legacy:8.1f} ns/request   binder: {t_binder:8.1f} ns/request   "
+          f"x{t_legacy / t_binder:.2f}")
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench(api_blogs, "/api/blogs", "page=3&size=20&utm_source=feed", None, number)
+    bench(manage_blogs, "/manage/blogs", "page=2", None, number)
+    bench(index, "/", "", None, number)
+
+
+if __name__ == '__main__':
+    main()
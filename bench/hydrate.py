@@ -0,0 +1,60 @@
+"""
+比较两种构造模型对象的方式，不需要连接数据库：
+  dict: DictCursor的行字典 + from_row（原来的cls(**r)路径）
+  tuple: 元组游标的行 + 生成的hydrator
+运行: python bench/hydrate.py [行数]
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "web"))
+
+from models import Blog, Comment, User  # noqa: E402
+from orm import Record, StringField, FloatField, TextField  # noqa: E402
+
+
+class TupleComment(Record):
+    __table__ = "comments"
+    __storage__ = "tuple"
+
+    id = StringField(primary_key=True, ddl="varchar(50)")
+    blog_id = StringField(ddl="varchar(50)")
+    user_id = StringField(ddl="varchar(50)")
+    user_name = StringField(ddl="varchar(50)")
+    user_image = StringField(ddl="varchar(500)")
+    content = TextField()
+    created_at = FloatField()
+
+
+def make_rows(model, n):
+    columns = tuple(model.__columns__)
+    rows = [tuple(f"{k}-{i}" if k != "created_at" else time.time() for k in columns) for i in range(n)]
+    return columns, rows
+
+
+def bench(model, n, number):
+    columns, rows = make_rows(model, n)
+
+    def by_dict():
+        # DictCursor为每行构造一个dict，再由from_row展开
+        return [model.from_row(dict(zip(columns, r))) for r in rows]
+
+    def by_tuple():
+        return list(map(model.hydrator(columns), rows))
+
+    t_dict = min(timeit.repeat(by_dict, number=number, repeat=5)) / number / n * 1e9
+    t_tuple = min(timeit.repeat(by_tuple, number=number, repeat=5)) / number / n * 1e9
+    print(f"{model.__name__:<14} dict+from_row: {t_dict:8.1f} ns/row   tuple+hydrator: {t_tuple:8.1f} ns/row   "
+          f"x{t_dict / t_tuple:.2f}")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for model in (User, Blog, Comment, TupleComment):
+        bench(model, n, 5)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,10 @@ from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
+import idgen
 import orm
+import sqlstats
+import coroweb
 from coroweb import add_routes, add_static
 from config import configs
 from handlers import COOKIE_NAME, cookie2user
@@ -30,6 +33,26 @@ def datetime_filter(t):
     return f"{dt.year}年{dt.month}月{dt.day}日"
 
 
+def json_default(o):
+    """Record等不是dict的模型通过to_dict序列化，其余对象用__dict__"""
+    to_dict = getattr(o, "to_dict", None)
+    return to_dict() if to_dict is not None else o.__dict__
+
+
+def jsonable(o):
+    """
+    把嵌套在dict和list中的模型换成to_dict()的结果（其中的ID是字符串）
+    json.dumps直接编码Model这样的dict子类，不会调用default，超过2^53的ID会在JavaScript中失去精度
+    """
+    if isinstance(o, orm.BaseModel):
+        o = o.to_dict()
+    if isinstance(o, dict):
+        return {k: jsonable(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [jsonable(v) for v in o]
+    return o
+
+
 def init_jinja2(app, **kwargs):
     logging.info("Init jinja2...")
     options = dict(
@@ -70,24 +93,32 @@ async def auth_factory(app, handler):
 
 
 async def data_factory(app, handler):
+    """预先解析请求体，结果缓存在request.__data__中，RequestHandler不会再次解析"""
     async def parse_data(request):
-        if request.method == "POST":
-            if request.content_type.startswith("application/json"):
-                request.__data__ = await request.json()
-                logging.info(f"Request json: {str(request.__data__)}")
-            elif request.content_type.startswith("application/x-www-form-urlencoded"):
-                request.__data__ = await request.post()
-                logging.info(f"Request form: {request.__data__}")
+        if request.method == "POST" and request.content_type.startswith(
+                ("application/json", "application/x-www-form-urlencoded")):
+            try:
+                data = await coroweb.read_body(request)
+            except coroweb.BodyTooLarge as e:
+                return web.Response(status=413, text=str(e))
+            except coroweb.ArgumentError as e:
+                return web.HTTPBadRequest(text=str(e))
+            # 只记录参数名，请求体可能很大且包含密码等数据
+            logging.debug(f"Request data: {', '.join(data.keys())}")
         return await handler(request)
 
     return parse_data
 
 
 async def init(loop):
+    idgen.configure(configs.id_worker)
+    coroweb.configure(configs.body.max_size, configs.body.offload_json_size)
     await orm.create_pool(loop=loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=[
-        auth_factory, logger_factory, response_factory
-    ])
+    middlewares = [auth_factory, logger_factory, response_factory]
+    if configs.query_detector.enabled:
+        # 放在最外层，认证时的查询也计入
+        middlewares.insert(0, query_factory)
+    app = web.Application(loop=loop, middlewares=middlewares, client_max_size=configs.body.max_size)
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, "handlers")
     add_static(app)
@@ -96,6 +127,28 @@ async def init(loop):
     return srv
 
 
+def route_name(request):
+    """ the method and route pattern of a request, such as GET /blog/{id}."""
+    route = request.match_info.route
+    resource = getattr(route, "resource", None)
+    return f"{request.method} {resource.canonical if resource is not None else request.path}"
+
+
+async def query_factory(app, handler):
+    """统计每个请求执行的语句，发现N+1和超出预算的请求，见configs.query_detector"""
+    options = configs.query_detector
+
+    async def detect(request):
+        with sqlstats.track(route_name(request), options.repeat_threshold, options.max_queries, options.max_db_ms,
+                            options.strict) as queries:
+            resp = await handler(request)
+        if options.header and isinstance(resp, web.StreamResponse) and not resp.prepared:
+            resp.headers["X-Query-Stats"] = queries.header(options.repeat_threshold)
+        return resp
+
+    return detect
+
+
 async def logger_factory(app, handler):
     async def logger(request):
         # 记录日志
@@ -123,10 +176,13 @@ async def response_factory(app, handler):
             resp = web.Response(body=r.encode("utf-8"))
             resp.content_type = "text/html;charset=utf-8"
             return resp
+        if isinstance(r, orm.BaseModel):
+            r = r.to_dict()
         if isinstance(r, dict):
             template = r.get("__template__")
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode("utf-8"))
+                body = json.dumps(jsonable(r), ensure_ascii=False, default=json_default)
+                resp = web.Response(body=body.encode("utf-8"))
                 resp.content_type = "application/json;charset=utf-8"
                 return resp
             else:
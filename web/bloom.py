@@ -0,0 +1,45 @@
+"""布隆过滤器：判断一个键“一定不存在”或“可能存在”，用于在查询数据库之前排除不存在的主键/唯一键"""
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    """
+    按容量和误判率计算位数组大小和哈希次数，多个哈希位置由一次blake2b摘要的两半通过双重哈希得到
+    只能添加不能删除，删除过的键在重建前仍被判断为可能存在
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        # 奇数步长，保证各位置互不相同
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self._bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return f"<BloomFilter {self.count}/{self.capacity} keys, {self.size} bits, {self.hashes} hashes>"
+
+    __repr__ = __str__
@@ -1,10 +1,9 @@
 import asyncio
-import functools
 import inspect
+import json
 import logging
 import os
-
-from urllib import parse
+import re
 
 from aiohttp import web
 
@@ -16,10 +15,8 @@ def add_route(app, fn):
     path = getattr(fn, "__route__", None)
     if path is None or method is None:
         raise ValueError(f"@get or @post not defined in {str(fn)}.")
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
     logging.info(f"Add route {method} {path} => {fn.__name__}({', '.join(inspect.signature(fn).parameters.keys())})")
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, RequestHandler(app, fn, path))
 
 
 def add_routes(app, module_name):
@@ -50,13 +47,10 @@ def get(path):
     """定义@get("/path")方法"""
 
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        wrapper.__method__ = "GET"
-        wrapper.__route__ = path
-        return wrapper
+        # 只标记路由，不再包装一层转发的函数
+        func.__method__ = "GET"
+        func.__route__ = path
+        return func
 
     return decorator
 
@@ -65,13 +59,10 @@ def post(path):
     """定义@post("/path")方法"""
 
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        wrapper.__method__ = "POST"
-        wrapper.__route__ = path
-        return wrapper
+        # 只标记路由，不再包装一层转发的函数
+        func.__method__ = "POST"
+        func.__route__ = path
+        return func
 
     return decorator
 
@@ -123,61 +114,183 @@ def has_var_kw_args(fn):
             return True
 
 
+class ArgumentError(Exception):
+    """请求参数缺失或无法转换为注解的类型，返回400"""
+    pass
+
+
+class BodyTooLarge(ArgumentError):
+    """请求体超过max_body_size，返回413"""
+    pass
+
+
+# 请求体的最大字节数，和超过多少字节的JSON在线程池中解析，由configure()设置
+_max_body_size = 1024 ** 2
+_offload_json_size = 256 * 1024
+
+_RE_PATH_VARIABLE = re.compile(r"\{(\w+)(?::[^}]*)?}")
+_TRUE = frozenset(("1", "true", "yes", "on"))
+_FALSE = frozenset(("0", "false", "no", "off", ""))
+# 生成的绑定函数中表示参数不存在
+_MISSING = object()
+
+
+def configure(max_body_size=1024 ** 2, offload_json_size=256 * 1024):
+    """ set the request body limits from configs.body, 0 keeps every JSON document on the event loop."""
+    global _max_body_size, _offload_json_size
+    _max_body_size = max_body_size
+    _offload_json_size = offload_json_size
+
+
+async def read_body(request):
+    """
+    解析POST请求体（JSON对象或表单），结果缓存在request.__data__中，同一请求中间件和处理函数只解析一次
+    超过offload_json_size的JSON在线程池中解析，不阻塞事件循环；超过max_body_size抛出BodyTooLarge
+    """
+    data = getattr(request, "__data__", _MISSING)
+    if data is not _MISSING:
+        return data
+    if not request.content_type:
+        raise ArgumentError("Missing Content-Type.")
+    if request.content_length is not None and request.content_length > _max_body_size:
+        raise BodyTooLarge(f"Request body too large: {request.content_length} > {_max_body_size} bytes")
+    ct = request.content_type.lower()
+    if ct.startswith("application/json"):
+        body = await request.read()
+        # 分块传输时没有Content-Length，读取后再检查
+        if len(body) > _max_body_size:
+            raise BodyTooLarge(f"Request body too large: {len(body)} > {_max_body_size} bytes")
+        try:
+            if _offload_json_size and len(body) >= _offload_json_size:
+                data = await asyncio.get_event_loop().run_in_executor(None, json.loads, body)
+            else:
+                data = json.loads(body)
+        except ValueError:
+            raise ArgumentError("Invalid JSON body.")
+        if not isinstance(data, dict):
+            raise ArgumentError("JSON body must be object.")
+    elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
+        data = await request.post()
+    else:
+        raise ArgumentError(f"Unsupported Content-Type: {request.content_type}")
+    request.__data__ = data
+    return data
+
+
+def get_coercer(name, annotation):
+    """ the function converting a request value to the annotated type (int, float or bool), None for no conversion."""
+    if annotation is bool:
+        def coerce(v):
+            if isinstance(v, bool):
+                return v
+            s = str(v).lower()
+            if s in _TRUE:
+                return True
+            if s in _FALSE:
+                return False
+            raise ArgumentError(f"Invalid argument: {name}")
+
+        return coerce
+    if annotation in (int, float):
+        def coerce(v):
+            try:
+                return annotation(v)
+            except (TypeError, ValueError):
+                raise ArgumentError(f"Invalid argument: {name}")
+
+        return coerce
+    return None
+
+
+def compile_binder(fn, path):
+    """
+    根据处理函数的签名生成绑定参数的函数，返回(bind, 是否需要查询参数或请求体)，如：
+        def bind_api_blogs(request, data):
+            kw = {}
+            if data is not None:
+                v = data.get('page', missing)
+                if v is not missing:
+                    kw['page'] = coerce_page(v)
+                ...
+            return kw
+    data是查询参数或请求体，没有时为None；命名关键字参数从data中取，按注解（int、float、bool）转换类型
+    路径变量按名称绑定，参数名可以多一个前导下划线（{id}对应_id，避免遮蔽内置名称）
+    """
+    sig = inspect.signature(fn)
+    params = sig.parameters
+    keyword_only = [p for p in params.values() if p.kind == inspect.Parameter.KEYWORD_ONLY]
+    var_kw = any(p.kind == inspect.Parameter.VAR_KEYWORD for p in params.values())
+    namespace = dict(missing=_MISSING, ArgumentError=ArgumentError)
+
+    def value_of(param, expr):
+        if param is None:
+            return expr
+        coerce = get_coercer(param.name, param.annotation)
+        if coerce is None:
+            return expr
+        namespace[f"coerce_{param.name}"] = coerce
+        return f"coerce_{param.name}({expr})"
+
+    src = [f"def bind_{fn.__name__}(request, data):", "    kw = {}"]
+    if var_kw:
+        src.append("    if data is not None:")
+        src.append("        for k in data.keys():")
+        src.append("            kw.setdefault(k, data.get(k))")
+    if keyword_only:
+        src.append("    if data is not None:")
+        for p in keyword_only:
+            src.append(f"        v = data.get({p.name!r}, missing)")
+            src.append("        if v is not missing:")
+            src.append(f"            kw[{p.name!r}] = {value_of(p, 'v')}")
+    bound = set()
+    variables = _RE_PATH_VARIABLE.findall(path)
+    if variables:
+        src.append("    match = request.match_info")
+    for name in variables:
+        target = next((k for k in (name, f"_{name}") if k in params and k != "request"), None)
+        if target is None and not var_kw:
+            raise ValueError(f"No parameter for path variable {{{name}}} in function: {fn.__name__}{str(sig)}")
+        target = target or name
+        bound.add(target)
+        src.append(f"    kw[{target!r}] = {value_of(params.get(target), f'match[{name!r}]')}")
+    if hav_request_arg(fn):
+        bound.add("request")
+        src.append("    kw['request'] = request")
+    for p in params.values():
+        if p.default is inspect.Parameter.empty and p.name not in bound and p.kind in (
+                inspect.Parameter.KEYWORD_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
+            src.append(f"    if {p.name!r} not in kw:")
+            src.append(f"        raise ArgumentError('Missing argument: {p.name}')")
+    src.append("    return kw")
+    exec("\n".join(src), namespace)
+    return namespace[f"bind_{fn.__name__}"], bool(keyword_only) or var_kw
+
+
 class RequestHandler(object):
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, path=""):
         self._app = app
+        self._name = fn.__name__
         self._func = fn
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._has_request_arg = hav_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        self._bind, self._reads_data = compile_binder(fn, path)
 
     async def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == "POST":
-                if not request.content_type:
-                    return web.HTTPBadRequest("Missing Content-Type.")
-                ct = request.content_type.lower()
-                if ct.startswith("application/json"):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest("JSON body must be object.")
-                    kw = params
-                elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest(f"Unsupported Content-Type: {request.content_type}")
-            if request.method == "GET":
-                qs = request.query_string
-                if qs:
-                    kw = {}
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_named_kw_args and self._named_kw_args:
-                copy = {}
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning(f"Duplicate arg name in named arg and kw args: {k}")
-                kw[k] = v
-        if self._has_request_arg:
-            kw["request"] = request
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest(f"Missing argument: {name}")
-        logging.info(f"Call with args: {str(kw)}")
+        data = None
+        try:
+            if self._reads_data:
+                if request.method == "POST":
+                    data = await read_body(request)
+                elif request.method == "GET" and request.query_string:
+                    data = request.query
+            kw = self._bind(request, data)
+        except BodyTooLarge as e:
+            return web.Response(status=413, text=str(e))
+        except ArgumentError as e:
+            return web.HTTPBadRequest(text=str(e))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(f"Call {self._name} with args: {', '.join(kw)}")
         try:
-            r = await self._func(**kw)
-            return r
+            r = self._func(**kw)
+            # 普通函数直接返回结果，协程函数（以及返回协程的装饰器）返回可等待对象
+            return (await r) if inspect.isawaitable(r) else r
         except APIError as e:
             return dict(error=e.error, data=e.data, mesage=e.message)
@@ -0,0 +1,91 @@
+"""
+数据库工具
+    python dbtool.py schema                 根据models中的模型输出建表语句
+    python dbtool.py advise shapes.jsonl    对应用执行过的查询（db.shapes_file记录的示例）执行EXPLAIN，
+                                            列出全表扫描、全索引扫描、filesort和临时表，有问题时退出码为1
+    python dbtool.py compress Blog content  把已有的数据分批改写为CompressedTextField的压缩格式
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+import orm
+import sqlstats
+from config import configs
+from models import Blog, Comment, User
+
+MODELS = (User, Blog, Comment)
+
+
+def schema():
+    print("\n\n".join(m.__ddl__ for m in MODELS))
+
+
+def explain_problems(plan):
+    """ the problems of one row of EXPLAIN output."""
+    problems = []
+    if plan.get("type") == "ALL":
+        problems.append("full table scan")
+    elif plan.get("type") == "index":
+        problems.append("full index scan")
+    extra = plan.get("Extra") or ""
+    if "Using filesort" in extra:
+        problems.append("filesort")
+    if "Using temporary" in extra:
+        problems.append("temporary table")
+    return problems
+
+
+async def advise(path):
+    # 只在主库上执行EXPLAIN，不记录EXPLAIN本身的形状
+    await orm.create_pool(None, **dict(configs.db, replicas=[], shapes_file=None))
+    found = 0
+    async with orm.connection():
+        for shape in sqlstats.load_shapes(path):
+            try:
+                plans = await orm.select("explain " + shape["sql"], shape["args"])
+            except Exception as e:
+                print(f"ERROR  {shape['fingerprint']}\n       {e}")
+                continue
+            for plan in plans:
+                problems = explain_problems(plan)
+                if problems:
+                    found += 1
+                    print(f"{', '.join(problems).upper()}  {shape['fingerprint']}\n"
+                          f"       table: {plan.get('table')}, rows: {plan.get('rows')}, "
+                          f"possible keys: {plan.get('possible_keys')}, key: {plan.get('key')}")
+    print(f"{found} problem(s) found.")
+    return found
+
+
+async def compress(model_name, column, batch_size):
+    await orm.create_pool(None, **dict(configs.db, replicas=[]))
+    model = next(m for m in MODELS if m.__name__ == model_name)
+    print(f"{await model.compress_column(column, batch_size)} row(s) compressed.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="aioweb database tool")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("schema", help="print the create table statements of the models")
+    p = commands.add_parser("advise", help="EXPLAIN the query shapes recorded in db.shapes_file")
+    p.add_argument("shapes_file")
+    p = commands.add_parser("compress", help="rewrite the existing values of a CompressedTextField column")
+    p.add_argument("model", choices=[m.__name__ for m in MODELS])
+    p.add_argument("column")
+    p.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args(argv)
+    if args.command == "schema":
+        schema()
+        return 0
+    loop = asyncio.get_event_loop()
+    if args.command == "compress":
+        loop.run_until_complete(compress(args.model, args.column, args.batch_size))
+        return 0
+    logging.getLogger().setLevel(logging.WARNING)
+    return 1 if loop.run_until_complete(advise(args.shapes_file)) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,42 @@
 configs = {
     "debug": True,
+    # 生成ID的worker id（0-1022），同时运行的每个进程必须不同
+    "id_worker": 0,
     "db": {
         "host": "127.0.0.1",
         "port": 3306,
         "user": "www",
         "password": "123",
-        "db": "aioweb"
+        "db": "aioweb",
+        # 只读副本，如[{"host": "10.0.0.2"}]，未指定的项沿用主库配置
+        "replicas": [],
+        # 写操作后多少秒内，本次请求的读操作仍走主库，0表示不启用
+        "read_your_writes": 0,
+        # 从副本读到的行在对象缓存中最多保留的秒数，应按可接受的副本延迟设置；0表示副本读取不写入对象缓存
+        "replica_cache_ttl": 5,
+        # 超过多少毫秒的语句记入慢查询日志（sql.slow），0表示不记录
+        "slow_query_ms": 200,
+        # 记录执行过的查询形状（每种一条示例语句和参数）的文件，供dbtool.py advise使用，None表示不记录
+        "shapes_file": None
+    },
+    # 统计每个请求执行的语句（开发环境和canary主机），发现N+1（同一语句形状重复执行）和超出预算的请求
+    "query_detector": {
+        "enabled": False,
+        # 同一语句形状在一个请求中执行多少次视为N+1
+        "repeat_threshold": 5,
+        # 每个请求的语句数和数据库耗时（毫秒）预算，0表示不限制
+        "max_queries": 0,
+        "max_db_ms": 0,
+        # 在响应头X-Query-Stats中返回统计
+        "header": False,
+        # 超出预算时请求失败（抛出sqlstats.QueryBudgetExceeded），用于测试
+        "strict": False
+    },
+    "body": {
+        # 请求体的最大字节数，超过时返回413
+        "max_size": 8 * 1024 ** 2,
+        # 超过多少字节的JSON请求体在线程池中解析，避免阻塞事件循环，0表示总在事件循环中解析
+        "offload_json_size": 1024 ** 2
     },
     "session": {
         "secret": "AioWeb"
@@ -8,7 +8,8 @@ import time
 from aiohttp import web
 
 import markdown2
-from apis import APIValueError, APIError, APIPermissionError, Page
+import orm
+from apis import APIValueError, APIError, APIPermissionError
 from config import configs
 from coroweb import get, post
 from models import User, Blog, next_id, Comment
@@ -19,6 +20,8 @@ _COOKIE_TIMEOUT = 60 * 60 * 24
 _RE_EMAIL = re.compile(r"^[a-z0-9.\-_]+@[a-z0-9\-_]+([.a-z0-9\-_]+){1,4}$")
 _RE_SHA1 = re.compile(r"^[0-9a-f]{40}$")
 _SESSION_TIMEOUT = 60 * 60 * 24
+_BLOGS_ORDER = "created_at desc"
+_MAX_PAGE_SIZE = 100
 
 
 @get("/")
@@ -36,14 +39,19 @@ async def index(request):
 
 
 @get("/api/blogs")
-async def api_blogs(*, page="1"):
-    page_index = get_page_index(page)
-    num = await Blog.find_number("count(id)")
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.find_all(order_by="created_at desc", limit=(p.offset, p.limit))
-    return dict(page=p, blogs=blogs)
+async def api_blogs(*, page: int = 1, after=None, size: int = 10):
+    """
+    按页码分页；或者传入after游标（首页传空字符串）按游标分页，返回的cursor用于请求下一页
+    """
+    page_size = get_page_size(size)
+    if after is not None:
+        try:
+            blogs = await Blog.find_all(order_by=_BLOGS_ORDER, after=after or None, limit=page_size)
+        except ValueError:
+            raise APIValueError("after", "Invalid cursor.")
+        return dict(blogs=blogs, cursor=next_cursor(Blog, blogs, page_size, _BLOGS_ORDER))
+    p, blogs = await Blog.find_page(get_page_index(page), page_size, order_by=_BLOGS_ORDER, after=None)
+    return dict(page=p, blogs=blogs, cursor=next_cursor(Blog, blogs, page_size, _BLOGS_ORDER))
 
 
 @get("/api/blogs/{id}")
@@ -56,15 +64,20 @@ async def api_get_users():
     users = await User.find_all(order_by='created_at desc')
     for u in users:
         u.pwd = "123123"
-    return dict(users=users)
+    return dict(users=[u.to_dict() for u in users])
 
 
 @get("/blog/{id}")
 async def get_blog(_id):
+    # 只读请求不固定连接，并发请求的相同查询可以合并，也可以读副本
     blog = await Blog.find(_id)
-    comments = await Comment.find_all("blog_id=?", [_id], order_by="created_at desc")
+    if blog is None:
+        raise web.HTTPNotFound()
+    # _id可能是迁移前的字符串主键
+    comments = await Comment.find_all("blog_id=?", [blog.id], order_by="created_at desc")
     for _ in comments:
         _.html_content = text2html(_.content)
+    await blog.inflate()
     blog.html_content = markdown2.markdown(blog.content)
     return {
         "__template__": "blog.html",
@@ -90,7 +103,7 @@ def logout(request):
 
 
 @get("/manage/blogs")
-def manage_blogs(*, page="1"):
+def manage_blogs(*, page: int = 1):
     return {
         "__template__": "manage_blogs.html",
         "page_index": get_page_index(page)
@@ -125,7 +138,7 @@ async def authenticate(*, email, pwd):
     user = users[0]
     # 校验密码
     sha1 = hashlib.sha1()
-    sha1.update(user.id.encode("utf-8"))
+    sha1.update(password_salt(user).encode("utf-8"))
     sha1.update(b":")
     sha1.update(pwd.encode("utf-8"))
     if user.pwd != sha1.hexdigest():
@@ -135,7 +148,7 @@ async def authenticate(*, email, pwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, _COOKIE_TIMEOUT), max_age=_SESSION_TIMEOUT, httponly="True")
     user.pwd = "123123"
     r.content_type = "application/json"
-    r.body = json.dumps(user, ensure_ascii=False).encode("utf-8")
+    r.body = json.dumps(user.to_dict(), ensure_ascii=False).encode("utf-8")
     return r
 
 
@@ -147,20 +160,20 @@ async def api_register_user(*, email, name, pwd):
         raise APIValueError("email")
     if not pwd or not _RE_SHA1.match(pwd):
         raise APIValueError("password")
-    users = await User.find_all("email=?", [email])
-    if len(users) > 0:
-        raise APIError("register: failed", "email", "Email is already in use.")
-    uid = next_id()
-    sha1_pwd = f"{uid}:{pwd}"
-    user = User(id=uid, name=name.strip(), email=email, pwd=hashlib.sha1(sha1_pwd.encode("utf-8")).hexdigest(),
-                image=f"http://www.gravatar.com/avatar/{hashlib.md5(email.encode('utf-8')).hexdigest()}?d=mm&s=120")
-    await user.save()
+    async with orm.transaction():
+        if await User.exists("email", email):
+            raise APIError("register: failed", "email", "Email is already in use.")
+        uid = next_id()
+        sha1_pwd = f"{uid}:{pwd}"
+        user = User(id=uid, name=name.strip(), email=email, pwd=hashlib.sha1(sha1_pwd.encode("utf-8")).hexdigest(),
+                    image=f"http://www.gravatar.com/avatar/{hashlib.md5(email.encode('utf-8')).hexdigest()}?d=mm&s=120")
+        await user.save()
     # 生成session
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, _COOKIE_TIMEOUT), max_age=_SESSION_TIMEOUT, httponly="True")
     user.pwd = "123123"
     r.content_type = "application/json"
-    r.body = json.dumps(user, ensure_ascii=False).encode("utf-8")
+    r.body = json.dumps(user.to_dict(), ensure_ascii=False).encode("utf-8")
     return r
 
 
@@ -228,6 +241,22 @@ def get_page_index(page_str):
     return p if p > 1 else 1
 
 
+def get_page_size(size_str):
+    s = 10
+    try:
+        s = int(size_str)
+    except ValueError as v:
+        pass
+    return min(max(s, 1), _MAX_PAGE_SIZE)
+
+
+def next_cursor(model, items, page_size, order_by):
+    """如果本页已满，返回指向下一页的游标"""
+    if len(items) < page_size:
+        return None
+    return model.seek_cursor(items[-1], order_by)
+
+
 def text2html(text):
     return "".join(
         map(
@@ -237,6 +266,11 @@ def text2html(text):
     )
 
 
+def password_salt(user):
+    """ the id string the password digest of user was computed with, the legacy id for migrated users."""
+    return user.legacy_id or str(user.id)
+
+
 def user2cookie(user, max_age):
     """
     根据用户(id-expires-sha1)生成cookie
@@ -246,5 +280,5 @@ def user2cookie(user, max_age):
     """
     expires = str(int(time.time() + max_age))
     s = f"{user.id}-{user.pwd}-{expires}-{_COOKIE_KEY}"
-    lis = [user.id, expires, hashlib.sha1(s.encode("utf-8")).hexdigest()]
+    lis = [str(user.id), expires, hashlib.sha1(s.encode("utf-8")).hexdigest()]
     return "-".join(lis)
@@ -0,0 +1,62 @@
+"""
+64位时间有序ID：41位毫秒时间戳（自EPOCH起，可用约69年）+ 10位worker id + 12位毫秒内序号
+新ID总是大于已生成的ID，插入时追加在主键索引末尾，不会造成页分裂
+"""
+import threading
+import time
+
+# 2015-01-01 00:00:00 UTC，早于所有旧数据的created_at，迁移时按created_at生成ID
+EPOCH = 1420070400000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+# 保留给schema.sql中的数据迁移，运行中的进程不能使用
+MIGRATION_WORKER = MAX_WORKER
+
+
+class IdGenerator(object):
+    """
+    同一进程内线程安全；每个同时运行的进程需要不同的worker_id
+    时钟回拨或一毫秒内序号用完时沿用（借用）上一个时间戳继续递增，不会阻塞事件循环
+    """
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id < MIGRATION_WORKER:
+            raise ValueError(f"Invalid worker id: {worker_id}, must be in [0, {MIGRATION_WORKER})")
+        self.worker_id = worker_id
+        self._last = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+            else:
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last += 1
+                    self._sequence = 0
+            return ((self._last - EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (
+                    self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_generator = IdGenerator()
+
+
+def configure(worker_id=0):
+    """ set the worker id of this process, from configs.id_worker."""
+    global _generator
+    _generator = IdGenerator(worker_id)
+
+
+def next_id():
+    return _generator.next_id()
+
+
+def timestamp_of(id_):
+    """ the creation time of an id in seconds since the unix epoch."""
+    return ((id_ >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000
@@ -1,45 +1,56 @@
 import time
-import uuid
 
-from orm import BooleanField, FloatField, Model, StringField, TextField
+from idgen import next_id
+from orm import BooleanField, CompressedTextField, FloatField, IdField, Index, Model, Record, StringField, TextField
 
 
-def next_id():
-    return "%015d%s000" % (int(time.time() * 1000), uuid.uuid4().hex)
-
-
-class Blog(Model):
+class Blog(Record):
     __table__ = "blogs"
-
-    id = StringField(primary_key=True, default=next_id, ddl="varchar(50)")
-    user_id = StringField(ddl="varchar(50)")
+    __cache__ = dict(ttl=300, maxsize=2048, miss_ttl=10)
+    # 热门日志的详情页会同时收到大量相同的查询
+    __coalesce__ = True
+
+    id = IdField(primary_key=True, default=next_id, legacy="legacy_id")
+    # 迁移前的字符串主键，旧链接仍可访问
+    legacy_id = StringField(ddl="varchar(50)", unique=True, null=True)
+    user_id = IdField()
     user_name = StringField(ddl="varchar(50)")
     user_image = StringField(ddl="varchar(500)")
     name = StringField(ddl="varchar(50)")
     summary = StringField(ddl="varchar(200)")
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = CompressedTextField(deferred=True)
+    created_at = FloatField(default=time.time, index=True)
 
 
-class Comment(Model):
+class Comment(Record):
     __table__ = "comments"
+    __coalesce__ = True
+    # get_blog按blog_id查询并按created_at排序
+    __indexes__ = (Index("blog_id", "created_at"),)
 
-    id = StringField(primary_key=True, default=next_id, ddl="varchar(50)")
-    blog_id = StringField(ddl="varchar(50)")
-    user_id = StringField(ddl="varchar(50)")
+    id = IdField(primary_key=True, default=next_id)
+    blog_id = IdField()
+    user_id = IdField()
     user_name = StringField(ddl="varchar(50)")
-    user_image = StringField(ddl="varchar(50)")
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    user_image = StringField(ddl="varchar(500)")
+    content = TextField(ddl="mediumtext")
+    created_at = FloatField(default=time.time, index=True)
 
 
 class User(Model):
     __table__ = "users"
+    __cache__ = dict(ttl=60, maxsize=4096, miss_ttl=10)
 
-    id = StringField(primary_key=True, default=next_id, ddl="varchar(50)")
-    email = StringField(ddl="varchar(50)")
+    id = IdField(primary_key=True, default=next_id, legacy="legacy_id")
+    # 迁移前的字符串主键，旧用户的密码摘要和cookie仍使用它
+    legacy_id = StringField(ddl="varchar(50)", unique=True, null=True)
+    email = StringField(ddl="varchar(50)", unique=True)
     pwd = StringField(ddl="varchar(50)")
     admin = BooleanField()
     name = StringField(ddl="varchar(50)")
     image = StringField(ddl="varchar(500)")
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+
+
+# /api/blogs每次翻页都要统计总数
+Blog.register_count("count(id)")
@@ -1,16 +1,67 @@
+import asyncio
+import base64
+import contextlib
+import contextvars
+import functools
+import json
 import logging
+import math
+import time
+import weakref
+import zlib
+from collections import OrderedDict
 
 import aiomysql
 
+import sqlstats
+from apis import Page
+from bloom import BloomFilter
+
 
 def log(sql, args=()):
     logging.info(f"SQL: {sql}")
 
 
-async def create_pool(loop, **kwargs):
-    logging.info("Creating database connection pool...")
-    global __pool
-    __pool = await aiomysql.create_pool(
+# 只读副本连续失败多少次后剔除，剔除多少秒
+_EJECT_AFTER = 3
+_EJECT_SECONDS = 30
+
+__replicas = []
+__read_your_writes = 0
+__replica_cache_ttl = 0
+# 本次请求（协程上下文）在此时间之前的读操作都走主库
+_primary_until = contextvars.ContextVar("primary_until", default=0.0)
+
+
+class Replica(object):
+    """只读副本的连接池，连续失败后在一段时间内不再使用"""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self):
+        return self.ejected_until <= time.monotonic()
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= _EJECT_AFTER:
+            logging.warning(f"Eject replica {self.name} for {_EJECT_SECONDS}s after {self.failures} failures")
+            self.failures = 0
+            self.ejected_until = time.monotonic() + _EJECT_SECONDS
+
+    def __str__(self):
+        return f"<Replica {self.name}, free: {self.pool.freesize}/{self.pool.size}>"
+
+
+async def _open_pool(loop, kwargs):
+    return await aiomysql.create_pool(
         host=kwargs.get("host", "localhost"),
         port=kwargs.get("port", 3306),
         user=kwargs["user"],
@@ -24,35 +75,376 @@ async def create_pool(loop, **kwargs):
     )
 
 
+async def create_pool(loop, **kwargs):
+    """
+    创建主库连接池；kwargs["replicas"]中的每一项创建一个只读副本连接池，未指定的配置沿用主库的
+    kwargs["read_your_writes"]秒数内，执行过写操作的请求继续从主库读
+    kwargs["replica_cache_ttl"]为从副本读到的行在对象缓存中最多保留的秒数，0表示副本读取不写入对象缓存，
+    这时配置了副本后对象缓存只由写操作和读主库的请求（事务外）填充
+    """
+    logging.info("Creating database connection pool...")
+    global __pool, __replicas, __read_your_writes, __replica_cache_ttl
+    __pool = await _open_pool(loop, kwargs)
+    replicas = []
+    for r in kwargs.get("replicas", None) or ():
+        options = dict(kwargs, **r)
+        name = f"{options.get('host', 'localhost')}:{options.get('port', 3306)}"
+        logging.info(f"Creating replica connection pool {name}...")
+        replicas.append(Replica(name, await _open_pool(loop, options)))
+    __replicas = replicas
+    __read_your_writes = kwargs.get("read_your_writes", 0)
+    __replica_cache_ttl = kwargs.get("replica_cache_ttl", 0)
+    sqlstats.configure(kwargs.get("slow_query_ms", 200), kwargs.get("shapes_file", None))
+
+
+class PinnedConnection(object):
+    """固定在当前协程上下文中的连接，connection()/transaction()内的所有ORM调用都使用它"""
+
+    def __init__(self, con):
+        self.con = con
+        # 同一上下文派生的并发任务共享连接，用锁保证语句串行执行
+        self.lock = asyncio.Lock()
+        self.depth = 0
+        self.on_commit = []
+
+
+_pinned = contextvars.ContextVar("pinned_connection", default=None)
+
+
+def pinned_connection():
+    """ the PinnedConnection of the current context, or None."""
+    return _pinned.get()
+
+
+def in_transaction():
+    pinned = _pinned.get()
+    return pinned is not None and pinned.depth > 0
+
+
+def on_commit(fn):
+    """ call fn once the current transaction commits, or right away outside a transaction."""
+    pinned = _pinned.get()
+    if pinned is not None and pinned.depth > 0:
+        pinned.on_commit.append(fn)
+    else:
+        fn()
+
+
+@contextlib.asynccontextmanager
+async def connection():
+    """ pin one primary connection for every ORM call in this context; nested calls reuse it."""
+    pinned = _pinned.get()
+    if pinned is not None:
+        yield pinned
+        return
+    async with __pool.get() as con:
+        pinned = PinnedConnection(con)
+        token = _pinned.set(pinned)
+        try:
+            yield pinned
+        finally:
+            _pinned.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    """
+    在固定的连接上开启事务，正常退出时提交，抛出异常时回滚
+    嵌套调用使用savepoint，只回滚内层的修改
+    """
+    async with connection() as pinned:
+        con = pinned.con
+        savepoint = f"sp_{pinned.depth}" if pinned.depth > 0 else None
+        callbacks = len(pinned.on_commit)
+        async with pinned.lock:
+            if savepoint is None:
+                await con.begin()
+            else:
+                await _execute(con, f"savepoint {savepoint}", ())
+        pinned.depth += 1
+        try:
+            yield pinned
+        except BaseException:
+            pinned.depth -= 1
+            del pinned.on_commit[callbacks:]
+            async with pinned.lock:
+                if savepoint is None:
+                    await con.rollback()
+                else:
+                    await _execute(con, f"rollback to savepoint {savepoint}", ())
+            raise
+        pinned.depth -= 1
+        async with pinned.lock:
+            if savepoint is None:
+                await con.commit()
+            else:
+                await _execute(con, f"release savepoint {savepoint}", ())
+        if savepoint is None:
+            callbacks, pinned.on_commit = pinned.on_commit, []
+            for fn in callbacks:
+                fn()
+
+
+def _detach():
+    """ called first in background tasks, which copy the context of their creator: never use its pinned connection
+    or count statements against its request."""
+    _pinned.set(None)
+    sqlstats.untrack()
+
+
+def pinned_to_primary():
+    """ whether reads in the current context must stay on the primary: a pinned connection or a recent write."""
+    return _pinned.get() is not None or _primary_until.get() > time.monotonic()
+
+
+def reads_from_primary():
+    return not __replicas or pinned_to_primary()
+
+
+def cache_fill_ttl():
+    """
+    the longest time rows read now may stay in a model cache, None if they must not be cached at all:
+    reads inside a transaction may see uncommitted data, and a lagging replica may return a row older than
+    the last write, so replica reads are cached for at most replica_cache_ttl seconds.
+    """
+    if in_transaction():
+        return None
+    if reads_from_primary():
+        return math.inf
+    return __replica_cache_ttl or None
+
+
+def choose_replica():
+    """ pick the healthy replica with the most free connections, or None to read from the primary."""
+    if reads_from_primary():
+        return None
+    best = None
+    for r in __replicas:
+        if r.healthy and (best is None or r.pool.freesize > best.pool.freesize):
+            best = r
+    if best is not None:
+        # 轮转，空闲连接数相同时均匀分摊
+        __replicas.remove(best)
+        __replicas.append(best)
+    return best
+
+
+async def _execute(con, sql, args, autocommit=True):
+    if not autocommit:
+        await con.begin()
+    try:
+        async with con.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(sql, args)
+            affected = cur.rowcount
+        await cur.close()
+        if not autocommit:
+            await con.commit()
+    except BaseException as e:
+        if not autocommit:
+            await con.rollback()
+        raise
+    return affected
+
+
+async def _run(fn, con, sql, args, started, *options):
+    """ run fn on an acquired connection, recording the pool wait since started, the execution time and rows."""
+    acquired = time.perf_counter()
+    try:
+        result = await fn(con, sql, args, *options)
+    except BaseException:
+        sqlstats.record(sql, args, acquired - started, time.perf_counter() - acquired, 0, True)
+        raise
+    rows = result if isinstance(result, int) else len(result)
+    sqlstats.record(sql, args, acquired - started, time.perf_counter() - acquired, rows)
+    return result
+
+
 async def execute(sql, args, autocommit=True):
+    sql = pyformat(sql)
     log(sql)
+    if __read_your_writes:
+        _primary_until.set(time.monotonic() + __read_your_writes)
+    started = time.perf_counter()
+    pinned = _pinned.get()
+    if pinned is not None:
+        async with pinned.lock:
+            # 已经在事务中时由transaction()负责提交
+            return await _run(_execute, pinned.con, sql, args, started, autocommit or pinned.depth > 0)
     async with __pool.get() as con:
-        if not autocommit:
-            await con.begin()
+        return await _run(_execute, con, sql, args, started, autocommit)
+
+
+class Rows(list):
+    """元组游标返回的行列表，columns为各列的名称"""
+    __slots__ = ("columns",)
+
+    def __init__(self, rows, columns):
+        super(Rows, self).__init__(rows)
+        self.columns = columns
+
+
+def column_names(cur):
+    return tuple(d[0] for d in cur.description)
+
+
+def is_internal_column(name):
+    """ columns like _num_ and _total_ are computed by the ORM itself and never hydrated."""
+    return name.startswith("_") and name.endswith("_")
+
+
+async def _fetch(con, sql, args, size, raw=False):
+    async with con.cursor(aiomysql.Cursor if raw else aiomysql.DictCursor) as cur:
+        await cur.execute(sql, args or ())
+        rs = await cur.fetchmany(size) if size else await cur.fetchall()
+        if raw:
+            rs = Rows(rs, column_names(cur))
+    await cur.close()
+    logging.info(f"Rows returned: {len(rs)}")
+    return rs
+
+
+async def _select(pool, sql, args, size, raw):
+    started = time.perf_counter()
+    async with pool.get() as con:
+        return await _run(_fetch, con, sql, args, started, size, raw)
+
+
+class Flight(object):
+    """一条正在执行的查询，相同语句和参数的并发调用共用它的结果，语句计入每个调用者的请求"""
+    __slots__ = ("task", "callers", "queries")
+
+    def __init__(self, task, queries):
+        self.task = task
+        self.callers = 1
+        self.queries = queries
+
+
+# (sql, args, size, raw, 是否读主库) ==> Flight
+_flights = {}
+
+
+def copy_rows(rs):
+    """ a private copy of a result set, so one caller's changes are never seen by another."""
+    if isinstance(rs, Rows):
+        # 元组不可变，复制列表即可
+        return Rows(rs, rs.columns)
+    return [dict(r) for r in rs]
+
+
+async def _fly(key, sql, args, size, raw, queries):
+    queries.enter()
+    try:
+        return await _route_select(sql, args, size, raw)
+    finally:
+        del _flights[key]
+
+
+async def select(sql, args, size=None, raw=False, coalesce=False):
+    """
+    run a query and return the rows as dicts, or as tuples in a Rows list when raw=True.
+    coalesce=True merges identical concurrent queries (same sql and args) into one execution,
+    every caller gets its own copy of the rows. queries on a pinned connection are never merged.
+    """
+    sql = pyformat(sql)
+    pinned = _pinned.get()
+    if pinned is not None:
+        log(sql, args)
+        started = time.perf_counter()
+        async with pinned.lock:
+            return await _run(_fetch, pinned.con, sql, args, started, size, raw)
+    if not coalesce:
+        log(sql, args)
+        return await _route_select(sql, args, size, raw)
+    key = (sql, tuple(args or ()), size, raw, reads_from_primary())
+    flight = _flights.get(key)
+    if flight is None:
+        log(sql, args)
+        queries = sqlstats.share()
+        flight = _flights[key] = Flight(asyncio.ensure_future(_fly(key, sql, args, size, raw, queries)), queries)
+    else:
+        flight.callers += 1
+        flight.queries.join()
+    # 取消一个调用者不会取消其他调用者共用的查询
+    rs = await asyncio.shield(flight.task)
+    return copy_rows(rs) if flight.callers > 1 else rs
+
+
+async def _route_select(sql, args, size, raw):
+    replica = choose_replica()
+    if replica is not None:
         try:
-            async with con.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace("?", "%s"), args)
-                affected = cur.rowcount
-            await cur.close()
-            if not autocommit:
-                await con.commit()
-        except BaseException as e:
-            if not autocommit:
-                await con.rollback()
-            raise
-        return affected
+            rs = await _select(replica.pool, sql, args, size, raw)
+        except (aiomysql.OperationalError, OSError, asyncio.TimeoutError) as e:
+            replica.failed()
+            logging.warning(f"Select on replica {replica.name} failed, retry on primary: {e}")
+        else:
+            replica.succeeded()
+            return rs
+    return await _select(__pool, sql, args, size, raw)
 
 
-async def select(sql, args, size=None):
+async def iterate(sql, args, batch_size=100, raw=False):
+    """
+    通过服务端游标（SSDictCursor，raw=True时为SSCursor）分批读取结果集，每批产出一个行列表
+    连接只在迭代期间占用；提前结束迭代时直接关闭连接，避免把剩余的结果集读完
+    在connection()/transaction()中时，未读完的结果会阻塞同一连接上的其他语句，因此一次读出后再分批产出
+    """
+    pinned = _pinned.get()
+    if pinned is not None:
+        rs = await select(sql, args, raw=raw)
+        for i in range(0, len(rs), batch_size):
+            yield Rows(rs[i:i + batch_size], rs.columns) if raw else rs[i:i + batch_size]
+        return
+    sql = pyformat(sql)
     log(sql, args)
-    global __pool
-    async with __pool.get() as con:
-        async with con.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace("?", "%s"), args or ())
-            rs = await cur.fetchmany(size) if size else await cur.fetchall()
+    replica = choose_replica()
+    pool = __pool if replica is None else replica.pool
+    started = time.perf_counter()
+    con = await pool.acquire()
+    acquired = time.perf_counter()
+    finished = False
+    rows = 0
+    # 只累计执行语句和读取每批的时间，不包括调用方处理每批数据的时间
+    elapsed = 0.0
+    try:
+        cur = await con.cursor(aiomysql.SSCursor if raw else aiomysql.SSDictCursor)
+        await cur.execute(sql, args or ())
+        columns = column_names(cur) if raw else None
+        elapsed = time.perf_counter() - acquired
+        while True:
+            fetching = time.perf_counter()
+            rs = await cur.fetchmany(batch_size)
+            elapsed += time.perf_counter() - fetching
+            if not rs:
+                break
+            rows += len(rs)
+            yield Rows(rs, columns) if raw else rs
         await cur.close()
-        logging.info(f"Rows returned: {len(rs)}")
-        return rs
+        finished = True
+    finally:
+        if not finished:
+            con.close()
+        await pool.release(con)
+        sqlstats.record(sql, args, acquired - started, elapsed, rows)
+
+
+def encode_cursor(values):
+    """ encode the seek values of the last row into an opaque pagination cursor."""
+    data = json.dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data.decode("utf-8"))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    # 游标的值直接作为语句参数，只接受标量，伪造的列表等会导致驱动报错
+    if not isinstance(values, list) or len(values) != 2 or not all(
+            isinstance(v, (int, float, str)) and not isinstance(v, bool) for v in values):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
 
 
 def create_args_string(num):
@@ -60,45 +452,588 @@ def create_args_string(num):
     return ", ".join(lis)
 
 
+class Statement(str):
+    """已转换为%s占位符的语句，select()/execute()直接使用，不再经过pyformat()"""
+    __slots__ = ()
+
+
+def to_pyformat(sql):
+    """ convert the ? placeholders used throughout the ORM to the %s placeholders of aiomysql."""
+    return Statement(sql.replace("?", "%s"))
+
+
+class StatementCache(object):
+    """编译好（已转换为%s占位符）的语句缓存，按语句形状索引，LRU淘汰"""
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def compile(self, key, fn, *args):
+        """ return the statement cached under key, calling fn(*args) to build it on a miss."""
+        sql = self._data.get(key)
+        if sql is not None:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return sql
+        self.misses += 1
+        sql = self._data[key] = fn(*args)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return sql
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+_statements = StatementCache()
+
+
+def pyformat(sql):
+    """ to_pyformat() cached per distinct statement, statements compiled by the ORM are returned as they are."""
+    if isinstance(sql, Statement):
+        return sql
+    return _statements.compile(sql, to_pyformat, sql)
+
+
+def statement_stats():
+    return _statements.stats()
+
+
+class DeferredFieldError(AttributeError):
+    """访问了未加载的延迟字段或未投影的字段"""
+    pass
+
+
+# 未加载字段在tuple存储中的占位值
+_UNLOADED = object()
+# 从数据库加载后未修改的对象共用的空修改集合，第一次修改时才分配set
+_CLEAN = frozenset()
+
+
 class Field(object):
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, deferred=False, index=False, unique=False,
+                 null=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        # 延迟字段默认不出现在find_all/iter_all的查询列中
+        self.deferred = deferred
+        # 单列索引，元类生成建表语句时创建idx_<列名>
+        self.index = index
+        self.unique = unique
+        self.null = null
 
     def __str__(self):
         return f"<{self.__class__.__name__}, {self.column_type}:{self.name}>"
 
 
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super().__init__(name, "boolean", False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, "boolean", False, default, index=index)
 
 
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, "bigint", primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, "bigint", primary_key, default, index=index, unique=unique)
+
+
+class IdField(Field):
+    """
+    64位整数ID（见idgen），主键或引用其他表主键的列
+    legacy为保存迁移前字符串主键的列名，find()收到不是整数的主键时按该列查找
+    """
+
+    def __init__(self, name=None, primary_key=False, default=None, legacy=None, index=False, unique=False):
+        super().__init__(name, "bigint", primary_key, default, index=index, unique=unique)
+        self.legacy = legacy
+
+    @staticmethod
+    def parse(value):
+        """ the integer id of value (an int or a string of digits), None if it is not one."""
+        if isinstance(value, int):
+            return value
+        # isdigit()对"²"等非ASCII数字也为True，int()却无法转换
+        if isinstance(value, str) and value.isascii() and value.isdigit() and len(value) <= 19:
+            value = int(value)
+            return value if value < 1 << 63 else None
+        return None
 
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, "real", primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, "real", primary_key, default, index=index)
 
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl="varchar(100)"):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl="varchar(100)", index=False, unique=False,
+                 null=False):
+        super().__init__(name, ddl, primary_key, default, index=index, unique=unique, null=null)
 
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, "text", False, default)
+    def __init__(self, name=None, default=None, deferred=False, ddl="text"):
+        super().__init__(name, ddl, False, default, deferred)
+
+
+class Codec(object):
+    """CompressedTextField使用的压缩算法，tag写在压缩数据前，用于读取时选择解压函数"""
+
+    def __init__(self, name, tag, compress, decompress):
+        self.name = name
+        self.tag = tag
+        self.compress = compress
+        self.decompress = decompress
+
+
+# 名称 ==> Codec，标签字节 ==> Codec
+_codecs = {}
+_codec_tags = {}
+
+
+def register_codec(codec):
+    """ make a codec available to CompressedTextField(codec=name); tags must never be reused."""
+    if codec.tag in _codec_tags and _codec_tags[codec.tag].name != codec.name:
+        raise ValueError(f"Duplicate codec tag {codec.tag!r}: {codec.name}, {_codec_tags[codec.tag].name}")
+    _codecs[codec.name] = codec
+    _codec_tags[codec.tag] = codec
+
+
+register_codec(Codec("zlib", b"z", functools.partial(zlib.compress, level=6), zlib.decompress))
+
+# 压缩数据的前缀，后跟1字节的codec标签；utf-8文本不会以NUL开头
+_COMPRESSED_MAGIC = b"\x00CZ"
+# 超过这个字节数的值在线程池中压缩/解压（zlib执行时释放GIL）
+_OFFLOOP_BYTES = 256 * 1024
+
+
+class CompressedTextField(Field):
+    """
+    压缩存储的文本（mediumblob列）：写入时压缩，加载后保持压缩形式，第一次访问属性时才解压
+    短于min_size字节的文本、迁移前的数据不带_COMPRESSED_MAGIC前缀，按utf-8原样读取
+    很大的值可以先await obj.inflate()在线程池中解压，避免在事件循环中解压
+    """
+
+    def __init__(self, name=None, default=None, deferred=False, codec="zlib", min_size=512, ddl="mediumblob"):
+        super().__init__(name, ddl, False, default, deferred)
+        self.codec = _codecs[codec]
+        self.min_size = min_size
+
+    def encode(self, text):
+        data = text.encode("utf-8")
+        if len(data) < self.min_size:
+            return data
+        return _COMPRESSED_MAGIC + self.codec.tag + self.codec.compress(data)
+
+    @staticmethod
+    def decode(value):
+        if isinstance(value, str):
+            # 列仍是text类型时驱动返回str
+            return value
+        value = bytes(value)
+        if value.startswith(_COMPRESSED_MAGIC):
+            n = len(_COMPRESSED_MAGIC)
+            return _codec_tags[value[n:n + 1]].decompress(value[n + 1:]).decode("utf-8")
+        return value.decode("utf-8")
+
+    async def encode_async(self, text):
+        if len(text) < _OFFLOOP_BYTES:
+            return self.encode(text)
+        return await asyncio.get_event_loop().run_in_executor(None, self.encode, text)
+
+    async def decode_async(self, value):
+        if len(value) < _OFFLOOP_BYTES:
+            return self.decode(value)
+        return await asyncio.get_event_loop().run_in_executor(None, self.decode, value)
+
+
+class _CompressedAttribute(object):
+    """包装Record中CompressedTextField的slot（或tuple存储的property），读取时解压并保存解压后的值"""
+
+    def __init__(self, inner, field):
+        self.inner = inner
+        self.field = field
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = self.inner.__get__(obj, cls)
+        if isinstance(value, (bytes, bytearray)):
+            value = self.field.decode(value)
+            self.inner.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        self.inner.__set__(obj, value)
+
+    def raw(self, obj):
+        try:
+            return self.inner.__get__(obj, type(obj))
+        except AttributeError:
+            return _UNLOADED
+
+
+class Index(object):
+    """多列索引，在模型的__indexes__中声明，如__indexes__ = (Index("blog_id", "created_at"),)；单列索引用Field(index=True)"""
+
+    def __init__(self, *columns, unique=False, name=None):
+        self.columns = columns
+        self.unique = unique
+        self.name = name or "idx_" + "_".join(columns)
+
+    def ddl(self):
+        return f"{'unique key' if self.unique else 'key'} `{self.name}` ({', '.join(f'`{c}`' for c in self.columns)})"
+
+    def __str__(self):
+        return f"<Index {self.ddl()}>"
+
+    __repr__ = __str__
+
+
+def create_table_sql(table_name, mappings, columns, primary_key, indexes):
+    """ the create table statement of a model, in the layout of schema.sql."""
+    name_width = max(len(c) for c in columns) + 2
+    type_width = max(len(mappings[c].column_type) for c in columns)
+    lines = [f"  {f'`{c}`'.ljust(name_width)} {mappings[c].column_type.ljust(type_width)} "
+             f"{'null' if mappings[c].null else 'not null'}" for c in columns]
+    # 唯一索引在前，与schema.sql一致
+    lines.extend(f"  {index.ddl()}" for index in sorted(indexes, key=lambda i: not i.unique))
+    lines.append(f"  primary key (`{primary_key}`)")
+    body = ",\n".join(lines)
+    return f"create table `{table_name}`\n(\n{body}\n) engine = innodb\n  default charset = utf8;"
+
+
+# 近似行数（information_schema中的统计值）的缓存秒数
+_ESTIMATE_TTL = 60
+# 单条IN查询最多携带的主键数量
+_MAX_BATCH = 500
+# 事件循环 ==> {模型: 批量加载器}
+_loaders = weakref.WeakKeyDictionary()
+
+
+class BatchLoader(object):
+    """合并同一事件循环周期内对同一模型的主键查询，用一条IN查询取回（DataLoader风格）"""
+
+    def __init__(self, model, loop, columns=None, coalesce=False):
+        self._model = model
+        self._loop = loop
+        self._columns = columns
+        self._coalesce = coalesce
+        self._pending = {}
+        self._queries = None  # 等待本批的请求，查询计入每个请求
+        self._scheduled = False
+
+    def load(self, pk):
+        """ return a future resolved with the row dict of pk, or None."""
+        fut = self._loop.create_future()
+        self._pending.setdefault(pk, []).append(fut)
+        if not self._scheduled:
+            self._scheduled = True
+            self._queries = sqlstats.share()
+            self._loop.call_soon(self._dispatch)
+        else:
+            self._queries.join()
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        queries, self._queries = self._queries, None
+        self._scheduled = False
+        self._loop.create_task(self._fetch(pending, queries))
+
+    async def _fetch(self, pending, queries):
+        queries.enter()
+        model = self._model
+        pk = model.__primary_key__
+        keys = list(pending.keys())
+        try:
+            for i in range(0, len(keys), _MAX_BATCH):
+                chunk = keys[i:i + _MAX_BATCH]
+                rs = await select(model.select_by_keys_sql(self._columns, len(chunk)), chunk,
+                                  coalesce=self._coalesce)
+                rows = {r[pk]: r for r in rs}
+                folded = None
+                for k in chunk:
+                    row = rows.get(k)
+                    if row is None and rs:
+                        # MySQL按排序规则和类型转换匹配（不区分大小写、忽略尾部空格、"5"等于5），按同样的规则再找一次
+                        if folded is None:
+                            folded = {_filter_key(r[pk]): r for r in rs}
+                        row = folded.get(_filter_key(k))
+                    for fut in pending.pop(k):
+                        if not fut.done():
+                            fut.set_result(row)
+        except Exception as e:
+            for futures in pending.values():
+                for fut in futures:
+                    if not fut.done():
+                        fut.set_exception(e)
+        finally:
+            for futures in pending.values():
+                for fut in futures:
+                    fut.cancel()
+
+
+# ModelCache.get()对已知不存在的主键的返回值
+_MISSING = object()
+
+
+class ModelCache(object):
+    """
+    模型对象缓存：按主键缓存行数据，过期时间+LRU淘汰，写操作时自动失效
+    miss_ttl大于0时同时缓存查不到的主键，get()返回_MISSING
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, miss_ttl=0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.miss_ttl = miss_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # 每次失效递增，防止并发的旧查询结果覆盖新数据
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def get(self, pk):
+        item = self._data.get(pk)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, row = item
+        if expires < time.monotonic():
+            del self._data[pk]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(pk)
+        if row is _MISSING:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return row
+
+    def put(self, pk, row, generation=None, max_ttl=math.inf):
+        if generation is not None and generation != self.generation:
+            return
+        self._store(pk, time.monotonic() + min(self.ttl, max_ttl), dict(row))
+
+    def put_missing(self, pk, generation=None, max_ttl=math.inf):
+        """ remember for miss_ttl seconds (at most max_ttl) that pk does not exist."""
+        if self.miss_ttl <= 0 or (generation is not None and generation != self.generation):
+            return
+        self._store(pk, time.monotonic() + min(self.miss_ttl, max_ttl), _MISSING)
+
+    def _store(self, pk, expires, row):
+        self._data[pk] = (expires, row)
+        self._data.move_to_end(pk)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, pk):
+        self.generation += 1
+        self._data.pop(pk, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl, miss_ttl=self.miss_ttl, hits=self.hits,
+                    negative_hits=self.negative_hits, misses=self.misses, evictions=self.evictions,
+                    expirations=self.expirations)
+
+
+def _filter_key(value):
+    # MySQL默认的排序规则不区分大小写、忽略尾部空格，归一化后只会多出误判，不会漏判
+    return str(value).rstrip(" ").lower()
+
+
+class KeyFilter(object):
+    """
+    已存在的主键/唯一键的布隆过滤器，过滤器判断不存在的键不必查询数据库
+    第一次使用时在后台从主库的表中构建，之后每rebuild秒重建一次（清除已删除的键）；构建完成前所有键都视为可能存在
+    save/update_时加入新的键，构建期间的写入在新过滤器替换旧过滤器时补上
+    只能看到本进程的写入：多个进程（不同的id_worker）写同一张表时，其他进程新增的键在下次重建前会被判断为不存在，
+    因此只能用于只有一个进程写入的表
+    """
+
+    def __init__(self, model, columns=None, capacity=100000, error_rate=0.01, rebuild=3600):
+        self.model = model
+        self.columns = tuple(columns or (model.__primary_key__,))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild = rebuild
+        self.built_at = 0.0
+        self.rejected = 0
+        self.passed = 0
+        self._filters = None  # column ==> BloomFilter
+        self._written = None  # 构建期间写入的(column, key)，构建完成后加入新的过滤器
+        self._building = None
+        self._due = 0.0
+
+    def might_contain(self, column, value):
+        """ False if no row has column=value for sure, True if it may exist."""
+        if self._building is None and self._due <= time.monotonic():
+            # 在调度构建任务时就开始记录写入，任务开始执行前的写入也不会丢失
+            self._written = []
+            self._building = asyncio.ensure_future(self._build())
+        filters = self._filters
+        if filters is None or value is None or column not in filters:
+            return True
+        if _filter_key(value) in filters[column]:
+            self.passed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def add(self, obj):
+        for column in self.columns:
+            self.add_value(column, obj.get_value(column))
+
+    def add_value(self, column, value):
+        if value is None or column not in self.columns:
+            return
+        key = _filter_key(value)
+        if self._filters is not None:
+            self._filters[column].add(key)
+        if self._written is not None:
+            self._written.append((column, key))
+
+    async def _build(self):
+        _detach()
+        # 副本可能缺少刚写入的行
+        _primary_until.set(math.inf)
+        model = self.model
+        try:
+            total = await model._load_number("count(*)", None, None)
+            capacity = max(self.capacity, 2 * (total or 0))
+            filters = {c: BloomFilter(capacity, self.error_rate) for c in self.columns}
+            sql = f"select {', '.join(f'`{c}`' for c in self.columns)} from `{model.__table__}`"
+            async for rs in iterate(sql, None, 1000, raw=True):
+                for r in rs:
+                    for column, value in zip(self.columns, r):
+                        if value is not None:
+                            filters[column].add(_filter_key(value))
+            for column, key in self._written:
+                filters[column].add(key)
+            self._filters = filters
+            self.built_at = time.monotonic()
+            self._due = self.built_at + self.rebuild
+            logging.info(f"Built key filter of {model.__name__}: {total} rows")
+        except Exception as e:
+            self._due = time.monotonic() + min(self.rebuild, 60)
+            logging.warning(f"Failed to build key filter of {model.__name__}: {e}")
+        finally:
+            self._written = None
+            self._building = None
+
+    def stats(self):
+        return dict(ready=self._filters is not None, columns=self.columns,
+                    age=time.monotonic() - self.built_at if self.built_at else None,
+                    rejected=self.rejected, passed=self.passed)
+
+
+def _tuple_property(index):
+    """ the accessor of one field of a tuple-backed Record, copying the row into a list on first write."""
+
+    def fget(self):
+        value = self._row[index]
+        if value is _UNLOADED:
+            raise DeferredFieldError(f"Field not loaded: {self.__class__.__name__}.{self.__columns__[index]}")
+        return value
+
+    def fset(self, value):
+        row = self._row
+        if type(row) is tuple:
+            row = self._row = list(row)
+        row[index] = value
+
+    return property(fget, fset)
+
+
+class CountCache(object):
+    """
+    find_number的计数缓存：save/remove时增量维护，超过refresh秒后在后台从数据库重新统计以纠正偏差
+    带where条件的计数需要提供与where等价的match(obj)才能增量维护，否则每次写操作后失效、下次读取时重新统计
+    """
+
+    def __init__(self, incremental, match=None, refresh=300):
+        self.incremental = incremental
+        self.match = match
+        self.refresh = refresh
+        self.value = None
+        self.loaded_at = 0.0
+        self.hits = 0
+        self.loads = 0
+        # 每次adjust/invalidate递增，统计期间有写操作时丢弃统计结果
+        self.generation = 0
+        self._loading = None
+
+    async def get(self, load):
+        """ the cached count, loading it with the coroutine function load() when missing."""
+        if self.value is None:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._load(load))
+            return await asyncio.shield(self._loading)
+        self.hits += 1
+        if time.monotonic() - self.loaded_at > self.refresh and self._loading is None:
+            self._loading = asyncio.ensure_future(self._load(load))
+        return self.value
+
+    async def _load(self, load):
+        _detach()
+        generation = self.generation
+        try:
+            value = await load()
+        except Exception as e:
+            if self.value is None:
+                raise
+            # 后台刷新失败时继续使用旧值
+            logging.warning(f"Failed to refresh count: {e}")
+            return self.value
+        finally:
+            self._loading = None
+        if generation != self.generation:
+            # 统计结果可能不包含期间的写入：首次加载时不保存，下次读取重新统计；后台刷新时保留已增量维护的旧值，下次读取再刷新
+            logging.info("Count changed while loading, result discarded")
+            return self.value if self.value is not None else value
+        self.value = value
+        self.loaded_at = time.monotonic()
+        self.loads += 1
+        return value
+
+    def adjust(self, obj, delta):
+        self.generation += 1
+        if not self.incremental:
+            self.value = None
+        elif self.value is not None and (self.match is None or self.match(obj)):
+            self.value += delta
+
+    def invalidate(self):
+        self.generation += 1
+        self.value = None
+
+    def stats(self):
+        return dict(value=self.value, age=time.monotonic() - self.loaded_at if self.loaded_at else None,
+                    hits=self.hits, loads=self.loads, incremental=self.incremental)
 
 
 class ModelMetaclass(type):
     def __new__(mcs, name, bases, attrs):
-        if name == "Model":
+        if name in ("BaseModel", "Model", "Record"):
             return type.__new__(mcs, name, bases, attrs)
         table_name = attrs.get("__table__", None) or name
         logging.info(f"Found model: {name} (table: {table_name})")
@@ -125,31 +1060,81 @@ class ModelMetaclass(type):
         attrs["__table__"] = table_name
         attrs["__primary_key__"] = primary_key  # 主键属性名
         attrs["__fields__"] = fields  # 除主键外的属性名
+        attrs["__columns__"] = [primary_key] + fields  # 与__select__的列顺序一致
+        deferred = [k for k in fields if mappings[k].deferred]
+        # find_all/iter_all默认查询的列，None表示全部
+        attrs["__eager__"] = tuple(k for k in attrs["__columns__"] if k not in deferred) if deferred else None
+        attrs["__projections__"] = {}  # 列元组 ==> select语句
+        attrs["__updates__"] = {}  # 列元组 ==> update语句
+        attrs["__inserts__"] = {}  # (行数, on_duplicate) ==> 多行insert语句
+        attrs["__hydrators__"] = {}  # 列元组 ==> 由元组行构造对象的函数
+        attrs["__counts__"] = {}  # (select_field, where, args) ==> CountCache
+        attrs["__estimate__"] = [None, 0.0]  # [近似行数, 过期时间]
+        indexes = [Index(k, unique=mappings[k].unique) for k in fields if mappings[k].index or mappings[k].unique]
+        for index in attrs.get("__indexes__", None) or ():
+            indexes.append(index if isinstance(index, Index) else Index(*index))
+        for index in indexes:
+            unknown = set(index.columns).difference(mappings)
+            if unknown:
+                raise Exception(f"Unknown columns in index {index.name}: {', '.join(sorted(unknown))}")
+        attrs["__indexes__"] = tuple(indexes)
+        attrs["__ddl__"] = create_table_sql(table_name, mappings, attrs["__columns__"], primary_key, indexes)
+        attrs["__codecs__"] = {k: v for k, v in mappings.items() if isinstance(v, CompressedTextField)}
+        # 序列化为json时转换为字符串，JavaScript的数字只有53位精度
+        attrs["__id_fields__"] = tuple(k for k, v in mappings.items() if isinstance(v, IdField))
+        storage = attrs.get("__storage__", None) or next(
+            (getattr(b, "__storage__") for b in bases if getattr(b, "__storage__", None)), None)
+        if storage == "slots":
+            attrs["__slots__"] = tuple(attrs["__columns__"]) + ("__dict__",)
+        elif storage == "tuple":
+            attrs["__slots__"] = ("_row", "__dict__")
+            for i, k in enumerate(attrs["__columns__"]):
+                attrs[k] = _tuple_property(i)
+        elif storage is not None:
+            raise ValueError(f"Invalid storage for model {name}: {storage}")
+        cache = attrs.get("__cache__", None)
+        attrs["__cache__"] = ModelCache(**cache) if isinstance(cache, dict) else cache
         attrs["__select__"] = f"""select `{primary_key}`, {", ".join(escaped_fields)} from `{table_name}`"""
-        attrs["__insert__"] = f"""insert into `{table_name}` ({", ".join(
-            escaped_fields)}, `{primary_key}`) values ({create_args_string(len(escaped_fields) + 1)})"""
-        attrs["__update__"] = f"""update `{table_name}` set {", ".join(
-            map(lambda f: f"`{mappings.get(f).name or f}`=?", fields))} where `{primary_key}`=?"""
-        attrs["__delete__"] = f"""delete from `{table_name}` where `{primary_key}`=?"""
-        return type.__new__(mcs, name, bases, attrs)
+        # 语句模板直接生成%s占位符，执行时不再转换
+        attrs["__insert__"] = to_pyformat(f"""insert into `{table_name}` ({", ".join(
+            escaped_fields)}, `{primary_key}`) values ({create_args_string(len(escaped_fields) + 1)})""")
+        attrs["__update__"] = to_pyformat(f"""update `{table_name}` set {", ".join(
+            map(lambda f: f"`{mappings.get(f).name or f}`=?", fields))} where `{primary_key}`=?""")
+        attrs["__delete__"] = to_pyformat(f"""delete from `{table_name}` where `{primary_key}`=?""")
+        cls = type.__new__(mcs, name, bases, attrs)
+        if storage is not None:
+            for k, field in attrs["__codecs__"].items():
+                setattr(cls, k, _CompressedAttribute(cls.__dict__[k], field))
+        bloom = attrs.get("__bloom__", None)
+        if isinstance(bloom, dict):
+            cls.__bloom__ = KeyFilter(cls, **bloom)
+        return cls
 
 
-class Model(dict, metaclass=ModelMetaclass):
-    def __init__(self, **kwargs):
-        super(Model, self).__init__(**kwargs)
-
-    def __getattr__(self, item):
-        try:
-            return self[item]
-        except KeyError:
-            raise AttributeError(r"'Model' object has no attribute '%s'" % item)
-
-    def __setattr__(self, key, value):
-        self[key] = value
+class BaseModel(metaclass=ModelMetaclass):
+    """查询与持久化方法；字段的存储方式由子类决定，见Model和Record"""
+    __slots__ = ()
+    # 是否合并并发的find(pk)调用
+    __batch__ = True
+    # 对象缓存配置，如dict(ttl=60, maxsize=1024)，由元类转换为ModelCache
+    __cache__ = None
+    # 是否合并相同的并发查询（语句和参数都相同），见select(coalesce=True)
+    __coalesce__ = False
+    __id_fields__ = ()
+    __codecs__ = {}
+    # 主键/唯一键的布隆过滤器配置，如dict(columns=("id", "email"), capacity=100000)，由元类转换为KeyFilter
+    __bloom__ = None
 
     def get_value(self, key):
         return getattr(self, key, None)
 
+    def is_loaded(self, key):
+        return getattr(self, key, _UNLOADED) is not _UNLOADED
+
+    def changed_fields(self):
+        """ the fields assigned a different value since the object was loaded or saved, None if not tracked."""
+        return self._changed
+
     def get_value_or_default(self, key):
         value = getattr(self, key, None)
         if value is None:
@@ -161,68 +1146,852 @@ class Model(dict, metaclass=ModelMetaclass):
         return value
 
     @classmethod
-    async def find_all(cls, where=None, args=None, **kwargs):
-        """ find object by where clause."""
-        sql = [cls.__select__]
+    def from_row(cls, row):
+        """ build an object from a row dict; columns missing from the row stay unloaded."""
+        return cls(**row)
+
+    @classmethod
+    def hydrator(cls, columns):
+        """ the function building an object from a tuple row with the given columns, generated once per column list."""
+        fn = cls.__hydrators__.get(columns)
+        if fn is None:
+            fn = cls.__hydrators__[columns] = cls._compile_hydrator(columns)
+        return fn
+
+    @classmethod
+    def projection(cls, columns=None):
+        """ normalize columns to a tuple in select order with the primary key first, None means all columns."""
+        if columns is None:
+            return None
+        wanted = set(columns)
+        unknown = wanted.difference(cls.__columns__)
+        if unknown:
+            raise ValueError(f"Unknown columns for {cls.__name__}: {', '.join(sorted(unknown))}")
+        wanted.add(cls.__primary_key__)
+        if len(wanted) == len(cls.__columns__):
+            return None
+        return tuple(k for k in cls.__columns__ if k in wanted)
+
+    @classmethod
+    def select_sql(cls, columns=None):
+        """ the select statement of a projection returned by projection()."""
+        if columns is None:
+            return cls.__select__
+        sql = cls.__projections__.get(columns)
+        if sql is None:
+            sql = f"""select {", ".join(f"`{k}`" for k in columns)} from `{cls.__table__}`"""
+            cls.__projections__[columns] = sql
+        return sql
+
+    @classmethod
+    def update_sql(cls, columns):
+        """ the update statement setting the given non-key columns."""
+        columns = tuple(columns)
+        if columns == tuple(cls.__fields__):
+            return cls.__update__
+        sql = cls.__updates__.get(columns)
+        if sql is None:
+            sql = to_pyformat(f"""update `{cls.__table__}` set {", ".join(
+                f"`{cls.__mappings__[k].name or k}`=?" for k in columns)} where `{cls.__primary_key__}`=?""")
+            cls.__updates__[columns] = sql
+        return sql
+
+    @classmethod
+    def insert_many_sql(cls, count, on_duplicate=None):
+        """ the insert statement for count rows, with on duplicate key update when on_duplicate="update"."""
+        key = (count, on_duplicate)
+        sql = cls.__inserts__.get(key)
+        if sql is None:
+            head, row = cls.__insert__.split(" values ")
+            sql = f"{head} values {', '.join([row] * count)}"
+            if on_duplicate == "update":
+                sql += " on duplicate key update " + ", ".join(
+                    f"`{k}`=values(`{k}`)" for k in map(lambda f: cls.__mappings__[f].name or f, cls.__fields__))
+            elif on_duplicate is not None:
+                raise ValueError(f"Invalid on_duplicate: {on_duplicate}")
+            cls.__inserts__[key] = sql
+        return sql
+
+    @classmethod
+    def parse_seek_order(cls, order_by):
+        """ parse an order_by usable for keyset pagination, e.g. "created_at desc"."""
+        parts = (order_by or cls.__primary_key__).replace("`", "").split()
+        if len(parts) > 2 or parts[0] not in cls.__mappings__ or (
+                len(parts) == 2 and parts[1].lower() not in ("asc", "desc")):
+            raise ValueError(f"Keyset pagination needs a single column order_by: {order_by}")
+        return parts[0], len(parts) == 2 and parts[1].lower() == "desc"
+
+    @classmethod
+    def seek_cursor(cls, obj, order_by=None):
+        """ build the cursor pointing after obj, to be passed as find_all(after=...)."""
+        column, _ = cls.parse_seek_order(order_by)
+        return encode_cursor((obj.get_value(column), obj.get_value(cls.__primary_key__)))
+
+    @classmethod
+    def build_select(cls, where=None, args=None, **kwargs):
+        """
+        build the select statement and its args for find_all/iter_all.
+        columns=[...] selects only those columns (plus the primary key), deferred fields are left out by default.
+        passing after=<cursor> (None for the first page) switches to keyset pagination:
+        rows are ordered by (order_by column, primary key) and start right after the cursor.
+        with_total=True appends the total row count before the limit as a last column named _total_.
+        the statement is compiled once per distinct shape and cached.
+        """
+        columns = kwargs.get("columns", None)
+        columns = cls.__eager__ if columns is None else cls.projection(columns)
+        with_total = kwargs.get("with_total", False)
+        order_by = kwargs.get("order_by", None)
+        seek = "after" in kwargs
+        after = kwargs.get("after", None)
+        limit = kwargs.get("limit", None)
+        if limit is None:
+            limit_shape = 0
+        elif isinstance(limit, int):
+            limit_shape = 1
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            limit_shape = 2
+        else:
+            raise ValueError(f"Invalid limit values: {str(limit)}")
+        shape = (columns, where, order_by, seek, after is not None, limit_shape, with_total)
+        sql = _statements.compile((cls, "select") + shape, cls._compile_select, *shape)
+        args = [] if args is None else list(args)
+        if after is not None:
+            value, pk = decode_cursor(after)
+            args.extend((value, value, pk))
+        if limit_shape == 1:
+            args.append(limit)
+        elif limit_shape == 2:
+            args.extend(limit)
+        return sql, args
+
+    @classmethod
+    def _compile_select(cls, columns, where, order_by, seek, after, limit_shape, with_total):
+        sql = [cls.select_sql(columns)]
+        if with_total:
+            # 窗口函数在limit之前计算，一次查询同时得到总数
+            sql[0] = sql[0].replace(" from `", ", count(*) over () `_total_` from `", 1)
+        if seek:
+            column, desc = cls.parse_seek_order(order_by)
+            direction = "desc" if desc else "asc"
+            order_by = f"`{column}` {direction}, `{cls.__primary_key__}` {direction}"
+            if after:
+                op = "<" if desc else ">"
+                cond = f"(`{column}` {op} ? or (`{column}` = ? and `{cls.__primary_key__}` {op} ?))"
+                where = f"({where}) and {cond}" if where else cond
         if where:
             sql.append("where")
             sql.append(where)
-        if args is None:
-            args = []
-        order_by = kwargs.get("order_by", None)
         if order_by:
             sql.append("order by")
             sql.append(order_by)
-        limit = kwargs.get("limit", None)
-        if limit is not None:
-            sql.append("limit")
-            if isinstance(limit, int):
-                sql.append("?")
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append("?, ?")
-                args.extend(limit)
-            else:
-                raise ValueError(f"Invalid limit values: {str(limit)}")
-        rs = await select(" ".join(sql), args)
-        return [cls(**r) for r in rs]
+        if limit_shape == 1:
+            sql.append("limit ?")
+        elif limit_shape == 2:
+            sql.append("limit ?, ?")
+        return to_pyformat(" ".join(sql))
 
     @classmethod
-    async def find_number(cls, select_field, where=None, args=None):
-        """ find number by select and where."""
-        sql = [f"select {select_field} _num_ from `{cls.__table__}`"]
-        if where:
-            sql.append("where")
-            sql.append(where)
-        rs = await select(" ".join(sql), args, 1)
+    async def find_all(cls, where=None, args=None, coalesce=None, **kwargs):
+        """ find object by where clause."""
+        sql, args = cls.build_select(where, args, **kwargs)
+        ttl = cache_fill_ttl()
+        cache = cls.__cache__ if ttl is not None else None
+        generation = cache.generation if cache is not None else None
+        rs = await select(sql, args, raw=True, coalesce=cls.__coalesce__ if coalesce is None else coalesce)
+        if cache is not None and len(rs.columns) == len(cls.__columns__):
+            for r in rs:
+                # 主键总是第一列
+                cache.put(r[0], dict(zip(rs.columns, r)), generation, ttl)
+        return list(map(cls.hydrator(rs.columns), rs))
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch_size=100, **kwargs):
+        """ iterate objects by where clause without loading the whole result set into memory."""
+        sql, args = cls.build_select(where, args, **kwargs)
+        batches = iterate(sql, args, batch_size, raw=True)
+        try:
+            async for rs in batches:
+                for obj in map(cls.hydrator(rs.columns), rs):
+                    yield obj
+        finally:
+            await batches.aclose()
+
+    @classmethod
+    async def find_number(cls, select_field, where=None, args=None, coalesce=None):
+        """ find number by select and where, served from memory for counts registered with register_count()."""
+        counter = cls.__counts__.get((select_field, where, tuple(args or ())))
+        if counter is not None and not in_transaction():
+            return await counter.get(functools.partial(cls._load_number, select_field, where, args))
+        return await cls._load_number(select_field, where, args, coalesce)
+
+    @classmethod
+    async def _load_number(cls, select_field, where, args, coalesce=None):
+        sql = _statements.compile((cls, "number", select_field, where), cls._compile_number, select_field, where)
+        rs = await select(sql, args, 1, coalesce=cls.__coalesce__ if coalesce is None else coalesce)
         if len(rs) == 0:
             return None
         return rs[0]["_num_"]
 
     @classmethod
-    async def find(cls, pk):
-        """ find object by primary key."""
-        rs = await select(f"{cls.__select__} where `{cls.__primary_key__}`=?", [pk], 1)
-        if len(rs) == 0:
+    async def estimate_count(cls):
+        """ the row count estimated from InnoDB statistics, cached for _ESTIMATE_TTL seconds."""
+        value, expires = cls.__estimate__
+        if value is None or expires < time.monotonic():
+            rs = await select("select table_rows _num_ from information_schema.tables "
+                              "where table_schema = database() and table_name = ?", [cls.__table__], 1)
+            value = rs[0]["_num_"] if len(rs) > 0 else 0
+            cls.__estimate__[:] = [value, time.monotonic() + _ESTIMATE_TTL]
+        return value
+
+    @classmethod
+    async def find_page(cls, page_index=1, page_size=10, where=None, args=None, order_by=None, approximate=False,
+                        coalesce=None, **kwargs):
+        """
+        得到总数和当前页的对象，返回(Page, 对象列表)
+        已用register_count注册了同一where的行数时使用计数缓存（首次调用时加载），再按页查询
+        否则通过count(*) over ()与当前页一起查询：MySQL需要先得到整个结果集再排序分页，只适合较小的表
+        approximate=True且没有where时，总数使用information_schema中的估计值，适合非常大的表
+        其余参数（columns、after等）同find_all
+        """
+        page_index = max(page_index, 1)
+        total = None
+        if approximate and where is None:
+            total = await cls.estimate_count()
+        elif not in_transaction():
+            row_counts = ("count(*)", f"count({cls.__primary_key__})", f"count(`{cls.__primary_key__}`)")
+            for (select_field, w, a), counter in cls.__counts__.items():
+                if select_field in row_counts and w == where and a == tuple(args or ()):
+                    total = await counter.get(functools.partial(cls._load_number, select_field, w, args))
+                    break
+        if total is not None:
+            p = Page(total, page_index, page_size)
+            if p.limit == 0:
+                return p, []
+            return p, await cls.find_all(where, args, coalesce, order_by=order_by, limit=(p.offset, p.limit), **kwargs)
+        sql, args_ = cls.build_select(where, args, order_by=order_by, limit=(page_size * (page_index - 1), page_size),
+                                      with_total=True, **kwargs)
+        rs = await select(sql, args_, raw=True, coalesce=cls.__coalesce__ if coalesce is None else coalesce)
+        if len(rs) > 0:
+            total = rs[0][-1]
+        elif page_index == 1:
+            total = 0
+        else:
+            # 页码超出范围时窗口函数没有返回行，只能另外统计
+            total = await cls.find_number("count(*)", where, args, coalesce)
+        p = Page(total, page_index, page_size)
+        return p, list(map(cls.hydrator(rs.columns), rs))
+
+    @classmethod
+    def register_count(cls, select_field="count(*)", where=None, args=None, match=None, refresh=300):
+        """
+        cache find_number(select_field, where, args) in memory, see CountCache.
+        match(obj) must tell whether obj satisfies where, for the count to be maintained incrementally.
+        """
+        if not select_field.lower().startswith("count("):
+            raise ValueError(f"Only counts can be cached: {select_field}")
+        counter = CountCache(where is None or match is not None, match, refresh)
+        cls.__counts__[(select_field, where, tuple(args or ()))] = counter
+        return counter
+
+    @classmethod
+    def count_stats(cls):
+        return {k: c.stats() for k, c in cls.__counts__.items()}
+
+    def _adjust_counts(self, delta):
+        for counter in self.__counts__.values():
+            on_commit(functools.partial(counter.adjust, self, delta))
+
+    @classmethod
+    def _invalidate_counts(cls, conditional_only=False):
+        for counter in cls.__counts__.values():
+            if not conditional_only or counter.match is not None or not counter.incremental:
+                on_commit(counter.invalidate)
+
+    @classmethod
+    def _compile_number(cls, select_field, where):
+        sql = f"select {select_field} _num_ from `{cls.__table__}`"
+        return to_pyformat(f"{sql} where {where}" if where else sql)
+
+    @classmethod
+    def select_by_keys_sql(cls, columns=None, count=1):
+        """ the select statement of a projection by count primary keys."""
+        return _statements.compile((cls, "keys", columns, count), cls._compile_select_by_keys, columns, count)
+
+    @classmethod
+    def _compile_select_by_keys(cls, columns, count):
+        pk = cls.__primary_key__
+        if count == 1:
+            return to_pyformat(f"{cls.select_sql(columns)} where `{pk}`=?")
+        return to_pyformat(f"{cls.select_sql(columns)} where `{pk}` in ({create_args_string(count)})")
+
+    @classmethod
+    def loader(cls, columns=None, coalesce=False):
+        """ get the batch loader of this model and projection bound to the current event loop."""
+        loop = asyncio.get_event_loop()
+        loaders = _loaders.setdefault(loop, {})
+        loader = loaders.get((cls, columns, coalesce))
+        if loader is None:
+            loader = loaders[(cls, columns, coalesce)] = BatchLoader(cls, loop, columns, coalesce)
+        return loader
+
+    @classmethod
+    async def load_row(cls, pk, columns=None, coalesce=None):
+        """ load the row dict of pk, merged with concurrent loads of the same projection."""
+        coalesce = cls.__coalesce__ if coalesce is None else coalesce
+        if cls.__batch__ and not pinned_to_primary():
+            return await cls.loader(columns, coalesce).load(pk)
+        rs = await select(cls.select_by_keys_sql(columns), [pk], 1, coalesce=coalesce)
+        return rs[0] if len(rs) > 0 else None
+
+    @classmethod
+    async def find(cls, pk, columns=None, coalesce=None):
+        """ find object by primary key, with all columns unless columns=[...] is given."""
+        columns = cls.projection(columns)
+        field = cls.__mappings__[cls.__primary_key__]
+        if isinstance(field, IdField):
+            key = IdField.parse(pk)
+            if key is None:
+                return await cls.find_legacy(pk, columns) if field.legacy else None
+            pk = key
+        keys = cls.__bloom__
+        if keys is not None and not keys.might_contain(cls.__primary_key__, pk):
+            return None
+        cache = cls.__cache__
+        if cache is not None:
+            row = cache.get(pk)
+            if row is _MISSING:
+                return None
+            if row is not None:
+                return cls.from_row(row)
+            generation = cache.generation
+            ttl = cache_fill_ttl()
+        row = await cls.load_row(pk, columns, coalesce)
+        if row is None:
+            if cache is not None and ttl is not None:
+                cache.put_missing(pk, generation, ttl)
             return None
-        return cls(**rs[0])
+        if cache is not None and columns is None and ttl is not None:
+            cache.put(pk, row, generation, ttl)
+        return cls.from_row(row)
+
+    @classmethod
+    async def find_legacy(cls, legacy_id, columns=None):
+        """ find object by the string primary key it had before the IdField migration."""
+        legacy = cls.__mappings__[cls.__primary_key__].legacy
+        # 与find()一致，默认包括延迟字段
+        objs = await cls.find_all(f"`{legacy}`=?", [legacy_id], columns=columns or cls.__columns__, limit=1)
+        return objs[0] if objs else None
+
+    @classmethod
+    async def exists(cls, column, value):
+        """ whether some row has column=value; keys ruled out by the key filter need no query."""
+        keys = cls.__bloom__
+        if keys is not None and not keys.might_contain(column, value):
+            return False
+        rs = await select(_statements.compile((cls, "exists", column), cls._compile_exists, column), [value], 1)
+        return len(rs) > 0
+
+    @classmethod
+    def _compile_exists(cls, column):
+        return to_pyformat(f"select 1 _num_ from `{cls.__table__}` where `{column}`=? limit 1")
+
+    @classmethod
+    async def prefetch_many(cls, objects, foreign_key, attr, limit=None, order_by=None, columns=None):
+        """
+        为objects（其他模型的对象）一次查询出本模型中foreign_key引用它们主键的行，以列表保存到每个对象的attr属性
+        如await Comment.prefetch_many(blogs, "blog_id", "comments", limit=3, order_by="created_at desc")
+        limit限制每个对象最多关联的行数（row_number() over (partition by ...)，需要MySQL 8）
+        """
+        # 和find_all一样，默认不查询延迟加载的列
+        if columns is None:
+            columns = cls.__eager__ or cls.__columns__
+        columns = cls.projection(tuple(columns) + (foreign_key,))
+        keys = list(dict.fromkeys(k for k in (o.get_value(o.__primary_key__) for o in objects) if k is not None))
+        groups = {}
+        for i in range(0, len(keys), _MAX_BATCH):
+            chunk = keys[i:i + _MAX_BATCH]
+            sql = _statements.compile((cls, "prefetch", columns, foreign_key, order_by, limit is not None, len(chunk)),
+                                      cls._compile_prefetch, columns, foreign_key, order_by, limit is not None,
+                                      len(chunk))
+            rs = await select(sql, chunk + [limit] if limit is not None else chunk, raw=True)
+            for obj in map(cls.hydrator(rs.columns), rs):
+                groups.setdefault(obj.get_value(foreign_key), []).append(obj)
+        for o in objects:
+            setattr(o, attr, groups.get(o.get_value(o.__primary_key__), []))
+        return objects
+
+    @classmethod
+    def _compile_prefetch(cls, columns, foreign_key, order_by, limited, count):
+        cond = f"`{foreign_key}` in ({create_args_string(count)})"
+        if not limited:
+            sql = f"{cls.select_sql(columns)} where {cond}"
+            return to_pyformat(f"{sql} order by {order_by}" if order_by else sql)
+        window = f"partition by `{foreign_key}` order by {order_by}" if order_by else f"partition by `{foreign_key}`"
+        ranked = cls.select_sql(columns).replace(" from `", f", row_number() over ({window}) `_rank_` from `", 1)
+        return to_pyformat(f"select * from ({ranked} where {cond}) `_ranked_` where `_rank_` <= ? "
+                           f"order by `{foreign_key}`, `_rank_`")
+
+    @classmethod
+    async def prefetch_one(cls, objects, foreign_key, attr, columns=None):
+        """
+        objects的foreign_key列引用本模型的主键，一次查询出被引用的对象保存到每个对象的attr属性（不存在时为None）
+        如await User.prefetch_one(blogs, "user_id", "user", columns=["name", "image"])；先使用对象缓存
+        和find_all一样，默认不查询延迟加载的列
+        """
+        columns = cls.__eager__ if columns is None else cls.projection(columns)
+        keys = list(dict.fromkeys(k for k in (o.get_value(foreign_key) for o in objects) if k is not None))
+        cache = cls.__cache__
+        found = {}
+        ttl = cache_fill_ttl()
+        if cache is not None:
+            generation = cache.generation
+            for k in keys:
+                row = cache.get(k)
+                if row is not None and row is not _MISSING:
+                    found[k] = cls.from_row(row)
+            keys = [k for k in keys if k not in found]
+        for i in range(0, len(keys), _MAX_BATCH):
+            chunk = keys[i:i + _MAX_BATCH]
+            rs = await select(cls.select_by_keys_sql(columns, len(chunk)), chunk, raw=True)
+            # 只缓存完整的行
+            if cache is not None and ttl is not None and len(rs.columns) == len(cls.__columns__):
+                for r in rs:
+                    # 主键总是第一列
+                    cache.put(r[0], dict(zip(rs.columns, r)), generation, ttl)
+            for obj in map(cls.hydrator(rs.columns), rs):
+                found[obj.get_value(cls.__primary_key__)] = obj
+        for o in objects:
+            setattr(o, attr, found.get(o.get_value(foreign_key)))
+        return objects
+
+    @classmethod
+    async def load_deferred(cls, objects, *names):
+        """ load the unloaded columns (default: all) of many objects, in one query per projection."""
+        await asyncio.gather(*[obj.undefer(*names) for obj in objects])
+        return objects
+
+    async def undefer(self, *names):
+        """ load the given unloaded columns (default: all) of this object."""
+        names = [k for k in (names or self.__columns__) if not self.is_loaded(k)]
+        if not names:
+            return self
+        pk = self.get_value(self.__primary_key__)
+        row = self.__cache__.get(pk) if self.__cache__ is not None else None
+        if row is _MISSING:
+            raise DeferredFieldError(f"Cannot load {', '.join(names)}: {self.__class__.__name__} {pk} not found")
+        if row is None:
+            row = await self.load_row(pk, self.projection(names))
+        if row is None:
+            raise DeferredFieldError(f"Cannot load {', '.join(names)}: {self.__class__.__name__} {pk} not found")
+        for k in names:
+            setattr(self, k, row[k])
+        changed = self.changed_fields()
+        if changed:
+            changed.difference_update(names)
+        return self
+
+    @classmethod
+    async def encode_values(cls, columns, values):
+        """ convert the values of columns in place to what is stored, compressing CompressedTextField values."""
+        codecs = cls.__codecs__
+        if codecs:
+            for i, k in enumerate(columns):
+                field = codecs.get(k)
+                if field is not None and isinstance(values[i], str):
+                    values[i] = await field.encode_async(values[i])
+        return values
+
+    async def inflate(self, *names):
+        """ decompress the loaded CompressedTextField values (default: all) now, large ones off the event loop."""
+        for k in names or self.__codecs__:
+            value = self._raw_value(k)
+            if isinstance(value, (bytes, bytearray)):
+                self._set_raw_value(k, await self.__codecs__[k].decode_async(value))
+        return self
+
+    @classmethod
+    async def compress_column(cls, name, batch_size=200):
+        """
+        迁移：按主键顺序分批把name列已有的值改写为CompressedTextField的格式，返回改写的行数
+        先把列改为blob类型（见schema.sql）；每批在一个事务中锁定后改写，可以在线上重复执行，已转换的行不再改写
+        """
+        field = cls.__codecs__[name]
+        pk = cls.__primary_key__
+        head = f"select `{pk}`, `{name}` from `{cls.__table__}`"
+        first = f"{head} order by `{pk}` limit ?"
+        following = f"{head} where `{pk}` > ? order by `{pk}` limit ?"
+        update = cls.update_sql((name,))
+        last = None
+        converted = 0
+        while True:
+            async with transaction():
+                # 锁定本批的行，读取和改写之间的编辑不会被旧值覆盖
+                rs = await select(f"{first if last is None else following} for update",
+                                  [batch_size] if last is None else [last, batch_size], raw=True)
+                if not rs:
+                    break
+                for key, value in rs:
+                    if value is None:
+                        continue
+                    if isinstance(value, str):
+                        raise ValueError(f"Column {cls.__table__}.{name} is not a blob column yet")
+                    data = await field.encode_async(field.decode(value))
+                    if data != value:
+                        await execute(update, [data, key])
+                        converted += 1
+            last = rs[-1][0]
+            logging.info(f"Compressed {cls.__table__}.{name}: {converted} rows, up to {pk}={last}")
+        if cls.__cache__ is not None:
+            cls.__cache__.clear()
+        return converted
+
+    def _refresh_cache(self, written=True):
+        """ drop the cached row of this object and store the written values instead."""
+        cache = self.__cache__
+        if cache is not None:
+            pk = self.get_value(self.__primary_key__)
+            cache.invalidate(pk)
+            if in_transaction():
+                # 提交前其他连接仍可能读到旧数据并写入缓存
+                on_commit(lambda: cache.invalidate(pk))
+            elif written and all(map(self.is_loaded, self.__fields__)):
+                cache.put(pk, {k: self.get_value(k) for k in self.__mappings__.keys()})
 
     async def save(self):
-        args = list(map(self.get_value_or_default, self.__fields__))
+        args = await self.encode_values(self.__fields__, list(map(self.get_value_or_default, self.__fields__)))
         args.append(self.get_value_or_default(self.__primary_key__))
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warning(f"Failed to insert record: affected rows: {rows}")
+        else:
+            self._adjust_counts(1)
+        self.mark_clean()
+        self._refresh_cache(rows == 1)
+        if self.__bloom__ is not None:
+            self.__bloom__.add(self)
+
+    @classmethod
+    async def save_many(cls, objects, chunk_size=500, on_duplicate=None):
+        """
+        批量插入，每chunk_size个对象一条多行insert语句，返回影响的行数
+        on_duplicate="update"时主键或唯一键冲突的行改为更新（MySQL对这些行计2行）
+        需要原子性时在transaction()中调用
+        """
+        objects = list(objects)
+        rows = 0
+        for i in range(0, len(objects), chunk_size):
+            chunk = objects[i:i + chunk_size]
+            args = []
+            for obj in chunk:
+                values = list(map(obj.get_value_or_default, cls.__fields__))
+                args.extend(await cls.encode_values(cls.__fields__, values))
+                args.append(obj.get_value_or_default(cls.__primary_key__))
+            rows += await execute(cls.insert_many_sql(len(chunk), on_duplicate), args)
+            # 每批成功后立即维护缓存和计数：后面的批失败时，已提交的批不会留下过期的缓存（包括“不存在”的记录）
+            for obj in chunk:
+                obj.mark_clean()
+                obj._refresh_cache(False)
+                if cls.__bloom__ is not None:
+                    cls.__bloom__.add(obj)
+                if on_duplicate is None:
+                    obj._adjust_counts(1)
+            if on_duplicate is not None:
+                # 无法区分插入和更新的行
+                cls._invalidate_counts()
+        return rows
 
     async def update_(self):
-        args = list(map(self.get_value, self.__fields__))
+        """ write the changed columns back; objects not loaded from the database write every loaded column."""
+        changed = self.changed_fields()
+        if changed is None:
+            columns = [k for k in self.__fields__ if self.is_loaded(k)]
+        else:
+            columns = [k for k in self.__fields__ if k in changed]
+        if not columns:
+            return
+        args = await self.encode_values(columns, list(map(self.get_value, columns)))
         args.append(self.get_value(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(self.update_sql(columns), args)
         if rows != 1:
             logging.warning(f"Failed to update by primary key: affected rows: {rows}")
+        elif self.__counts__:
+            # 修改可能改变对象是否满足带条件的计数
+            self._invalidate_counts(conditional_only=True)
+        if self.__bloom__ is not None and any(k in self.__bloom__.columns for k in columns):
+            self.__bloom__.add(self)
+        self.mark_clean()
+        self._refresh_cache(rows == 1)
 
     async def remove(self):
         args = [self.get_value(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warning(f"Failed to remove by primary key: affected rows: {rows}")
+        else:
+            self._adjust_counts(-1)
+        self._refresh_cache(False)
+
+    @classmethod
+    async def update_where(cls, values, where, args=None, chunk_size=1000):
+        """
+        把满足where的所有行的列改为values（{属性名: 值}），返回影响的行数
+        按主键顺序分批执行，每批一个事务（已在事务中时为savepoint），避免长时间持有大量行锁和过大的undo日志
+        """
+        columns = tuple(values.keys())
+        unknown = set(columns).difference(cls.__fields__)
+        if unknown:
+            raise ValueError(f"Cannot update columns of {cls.__name__}: {', '.join(sorted(unknown))}")
+        encoded = await cls.encode_values(columns, [values[k] for k in columns])
+        keys = cls.__bloom__
+        if keys is not None:
+            for k, v in zip(columns, encoded):
+                keys.add_value(k, v)
+
+        def write(pks):
+            sql = _statements.compile((cls, "update_where", columns, where, len(pks)), cls._compile_update_where,
+                                      columns, where, len(pks))
+            return execute(sql, encoded + pks + list(args or ()))
+
+        rows = await cls._for_each_chunk(where, args, chunk_size, write)
+        if rows:
+            cls._invalidate_counts(conditional_only=True)
+        return rows
+
+    @classmethod
+    async def delete_where(cls, where, args=None, chunk_size=1000):
+        """ delete all rows matching where in primary key chunks like update_where, return the deleted row count."""
+
+        def write(pks):
+            sql = _statements.compile((cls, "delete_where", where, len(pks)), cls._compile_delete_where,
+                                      where, len(pks))
+            return execute(sql, pks + list(args or ()))
+
+        rows = await cls._for_each_chunk(where, args, chunk_size, write)
+        if rows:
+            for counter in cls.__counts__.values():
+                if counter.incremental and counter.match is None:
+                    on_commit(functools.partial(counter.adjust, None, -rows))
+                else:
+                    on_commit(counter.invalidate)
+        return rows
+
+    @classmethod
+    async def _for_each_chunk(cls, where, args, chunk_size, write):
+        """ call write(pks) for the primary keys matching where, chunk_size keys per transaction."""
+        pk = cls.__primary_key__
+        first = f"select `{pk}` from `{cls.__table__}` where ({where}) order by `{pk}` limit ?"
+        following = f"select `{pk}` from `{cls.__table__}` where ({where}) and `{pk}` > ? order by `{pk}` limit ?"
+        last = None
+        rows = 0
+        while True:
+            async with transaction():
+                # 在事务的连接上（主库）选出本批的主键，并锁定这些行
+                rs = await select(f"{first if last is None else following} for update",
+                                  list(args or ()) + ([chunk_size] if last is None else [last, chunk_size]), raw=True)
+                if not rs:
+                    break
+                pks = [r[0] for r in rs]
+                rows += await write(pks)
+                cache = cls.__cache__
+                if cache is not None:
+                    for key in pks:
+                        cache.invalidate(key)
+                        on_commit(functools.partial(cache.invalidate, key))
+            last = pks[-1]
+            if len(pks) < chunk_size:
+                break
+        return rows
+
+    @classmethod
+    def _compile_update_where(cls, columns, where, count):
+        return to_pyformat(f"""update `{cls.__table__}` set {", ".join(
+            f"`{cls.__mappings__[k].name or k}`=?" for k in columns)} """
+                           f"""where `{cls.__primary_key__}` in ({create_args_string(count)}) and ({where})""")
+
+    @classmethod
+    def _compile_delete_where(cls, where, count):
+        return to_pyformat(f"delete from `{cls.__table__}` "
+                           f"where `{cls.__primary_key__}` in ({create_args_string(count)}) and ({where})")
+
+
+class Model(dict, BaseModel):
+    """以dict保存字段的模型，可直接json序列化"""
+
+    def __init__(self, **kwargs):
+        self.__dict__["_changed"] = None
+        super(Model, self).__init__(**kwargs)
+
+    def __getattr__(self, item):
+        try:
+            value = self[item]
+        except KeyError:
+            if item in self.__mappings__:
+                raise DeferredFieldError(f"Field not loaded: {self.__class__.__name__}.{item}")
+            raise AttributeError(r"'Model' object has no attribute '%s'" % item)
+        if isinstance(value, (bytes, bytearray)) and item in self.__codecs__:
+            value = self.__codecs__[item].decode(value)
+            dict.__setitem__(self, item, value)
+        return value
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __setitem__(self, key, value):
+        changed = self._changed
+        if changed is not None and key in self.__mappings__ and self.get(key, _UNLOADED) != value:
+            if changed is _CLEAN:
+                changed = self.__dict__["_changed"] = set()
+            changed.add(key)
+        dict.__setitem__(self, key, value)
+
+    @classmethod
+    def from_row(cls, row):
+        obj = cls(**row)
+        obj.mark_clean()
+        return obj
+
+    @classmethod
+    def _compile_hydrator(cls, columns):
+        if any(map(is_internal_column, columns)):
+            items = ", ".join(f"{k!r}: r[{i}]" for i, k in enumerate(columns) if not is_internal_column(k))
+            init = f"    init(o, {{{items}}})"
+        else:
+            init = "    init(o, zip(columns, r))"
+        src = [
+            f"def hydrate_{cls.__name__}(r):",
+            "    o = new(cls)",
+            init,
+            "    o.__dict__['_changed'] = clean",
+            "    return o",
+        ]
+        namespace = dict(new=dict.__new__, cls=cls, init=dict.__init__, columns=columns, clean=_CLEAN)
+        exec("\n".join(src), namespace)
+        return namespace[f"hydrate_{cls.__name__}"]
+
+    def mark_clean(self):
+        self.__dict__["_changed"] = _CLEAN
+
+    def get_value(self, key):
+        return self.get(key)
+
+    def is_loaded(self, key):
+        return key in self
+
+    def _raw_value(self, key):
+        return self.get(key, _UNLOADED)
+
+    def _set_raw_value(self, key, value):
+        dict.__setitem__(self, key, value)
+
+    def to_dict(self):
+        d = dict(self)
+        for k in self.__codecs__:
+            if isinstance(d.get(k), (bytes, bytearray)):
+                d[k] = getattr(self, k)
+        for k in self.__id_fields__:
+            if d.get(k) is not None:
+                d[k] = str(d[k])
+        return d
+
+
+class Record(BaseModel):
+    """
+    以__slots__保存字段的模型，由元类根据__mappings__生成，比Model占用更少内存，字段访问也不经过__getattr__
+    __storage__ = "tuple"时所有字段值共用一个元组（第一次写入时复制为列表）
+    未映射的属性（如模板用的html_content）保存在实例的__dict__中
+    """
+    # 修改过的字段，None表示不跟踪（不是从数据库加载的对象）
+    __slots__ = ("_changed",)
+    __storage__ = "slots"
+
+    def __init__(self, **kwargs):
+        object.__setattr__(self, "_changed", None)
+        if self.__storage__ == "tuple":
+            self._row = [None] * len(self.__columns__)
+        else:
+            for k in self.__columns__:
+                setattr(self, k, None)
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def __getattr__(self, item):
+        # 只有未赋值的slot和不存在的属性会走到这里
+        if item in self.__mappings__:
+            raise DeferredFieldError(f"Field not loaded: {self.__class__.__name__}.{item}")
+        raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{item}'")
+
+    def __setattr__(self, key, value):
+        changed = self._changed
+        if changed is not None and key in self.__mappings__ and getattr(self, key, _UNLOADED) != value:
+            if changed is _CLEAN:
+                changed = set()
+                object.__setattr__(self, "_changed", changed)
+            changed.add(key)
+        object.__setattr__(self, key, value)
+
+    @classmethod
+    def from_row(cls, row):
+        obj = cls.__new__(cls)
+        set_ = object.__setattr__
+        if cls.__storage__ == "tuple":
+            set_(obj, "_row", tuple(row.get(k, _UNLOADED) for k in cls.__columns__))
+        else:
+            for k, v in row.items():
+                set_(obj, k, v)
+        set_(obj, "_changed", _CLEAN)
+        return obj
+
+    @classmethod
+    def _compile_hydrator(cls, columns):
+        """
+        生成形如下面的函数，直接通过slot描述符赋值，不经过__setattr__：
+            def hydrate_Blog(r):
+                o = new(cls)
+                set_id(o, r[0])
+                ...
+        """
+        namespace = dict(new=object.__new__, cls=cls, clean=_CLEAN, unloaded=_UNLOADED,
+                         set_changed=Record._changed.__set__)
+        src = [f"def hydrate_{cls.__name__}(r):", "    o = new(cls)"]
+        if cls.__storage__ == "tuple":
+            namespace["set_row"] = cls._row.__set__
+            if columns == tuple(cls.__columns__):
+                # 直接保存游标返回的元组，不复制
+                src.append("    set_row(o, r)")
+            else:
+                items = [f"r[{columns.index(k)}]" if k in columns else "unloaded" for k in cls.__columns__]
+                src.append(f"    set_row(o, ({', '.join(items)},))")
+        for i, k in enumerate(columns):
+            if is_internal_column(k):
+                continue
+            if k not in cls.__mappings__:
+                src.append(f"    o.__dict__[{k!r}] = r[{i}]")
+            elif cls.__storage__ != "tuple":
+                namespace[f"set_{i}"] = getattr(cls, k).__set__
+                src.append(f"    set_{i}(o, r[{i}])")
+        src.append("    set_changed(o, clean)")
+        src.append("    return o")
+        exec("\n".join(src), namespace)
+        return namespace[f"hydrate_{cls.__name__}"]
+
+    def mark_clean(self):
+        object.__setattr__(self, "_changed", _CLEAN)
+
+    def _raw_value(self, key):
+        return getattr(type(self), key).raw(self)
+
+    def _set_raw_value(self, key, value):
+        getattr(type(self), key).inner.__set__(self, value)
+
+    def to_dict(self):
+        """ the loaded fields and extra attributes as a dict, for json serialization."""
+        d = {}
+        for k in self.__columns__:
+            v = getattr(self, k, _UNLOADED)
+            if v is not _UNLOADED:
+                d[k] = str(v) if v is not None and k in self.__id_fields__ else v
+        d.update(self.__dict__)
+        return d
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.to_dict()}>"
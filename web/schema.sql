@@ -9,46 +9,123 @@ create user 'www'@'localhost' identified by '123';
 grant select, insert, update, delete on aioweb.* to 'www'@'localhost';
 flush privileges;
 
-create table users
+-- 以下建表语句由python dbtool.py schema根据models生成，修改模型后重新生成
+create table `users`
 (
-  `id`         varchar(50)  not null,
+  `id`         bigint       not null,
+  `legacy_id`  varchar(50)  null,
   `email`      varchar(50)  not null,
   `pwd`        varchar(50)  not null,
-  `admin`      bool         not null,
+  `admin`      boolean      not null,
   `name`       varchar(50)  not null,
   `image`      varchar(500) not null,
   `created_at` real         not null,
+  unique key `idx_legacy_id` (`legacy_id`),
   unique key `idx_email` (`email`),
   key `idx_created_at` (`created_at`),
   primary key (`id`)
 ) engine = innodb
   default charset = utf8;
 
-create table blogs
+create table `blogs`
 (
-  `id`         varchar(50)  not null,
-  `user_id`    varchar(50)  not null,
+  `id`         bigint       not null,
+  `legacy_id`  varchar(50)  null,
+  `user_id`    bigint       not null,
   `user_name`  varchar(50)  not null,
   `user_image` varchar(500) not null,
   `name`       varchar(50)  not null,
   `summary`    varchar(200) not null,
-  `content`    mediumtext   not null,
+  `content`    mediumblob   not null,
   `created_at` real         not null,
+  unique key `idx_legacy_id` (`legacy_id`),
   key `idx_created_at` (`created_at`),
   primary key (`id`)
 ) engine = innodb
   default charset = utf8;
 
-create table comments
+create table `comments`
 (
-  `id`         varchar(50)  not null,
-  `blog_id`    varchar(50)  not null,
-  `user_id`    varchar(50)  not null,
+  `id`         bigint       not null,
+  `blog_id`    bigint       not null,
+  `user_id`    bigint       not null,
   `user_name`  varchar(50)  not null,
   `user_image` varchar(500) not null,
   `content`    mediumtext   not null,
   `created_at` real         not null,
   key `idx_created_at` (`created_at`),
+  key `idx_blog_id_created_at` (`blog_id`, `created_at`),
   primary key (`id`)
 ) engine = innodb
   default charset = utf8;
+
+-- 从varchar(50)主键迁移到64位ID（见idgen.py），已有数据库先备份，再单独执行下面注释中的语句：
+-- 旧主键保存到legacy_id，按created_at生成新ID，worker id使用保留给迁移的1023，1420070400000为idgen.EPOCH
+-- 旧的链接、cookie和密码摘要通过legacy_id继续有效
+/*
+use aioweb;
+
+alter table users
+  add column `new_id` bigint null,
+  add column `legacy_id` varchar(50) null;
+alter table blogs
+  add column `new_id` bigint null,
+  add column `legacy_id` varchar(50) null,
+  add column `new_user_id` bigint null;
+alter table comments
+  add column `new_id` bigint null,
+  add column `new_blog_id` bigint null,
+  add column `new_user_id` bigint null;
+
+update users u join (select `id`, row_number() over (partition by floor(`created_at` * 1000) order by `id`) - 1 seq
+                     from users) t on u.`id` = t.`id`
+set u.`legacy_id` = u.`id`,
+    u.`new_id`    = ((floor(u.`created_at` * 1000) - 1420070400000) << 22) | (1023 << 12) | t.seq;
+update blogs b join (select `id`, row_number() over (partition by floor(`created_at` * 1000) order by `id`) - 1 seq
+                     from blogs) t on b.`id` = t.`id`
+set b.`legacy_id` = b.`id`,
+    b.`new_id`    = ((floor(b.`created_at` * 1000) - 1420070400000) << 22) | (1023 << 12) | t.seq;
+update comments c join (select `id`, row_number() over (partition by floor(`created_at` * 1000) order by `id`) - 1 seq
+                        from comments) t on c.`id` = t.`id`
+set c.`new_id` = ((floor(c.`created_at` * 1000) - 1420070400000) << 22) | (1023 << 12) | t.seq;
+
+-- 引用其他表的列，引用的行已不存在时为0
+update blogs b left join users u on b.`user_id` = u.`legacy_id`
+set b.`new_user_id` = coalesce(u.`new_id`, 0);
+update comments c left join blogs b on c.`blog_id` = b.`legacy_id` left join users u on c.`user_id` = u.`legacy_id`
+set c.`new_blog_id` = coalesce(b.`new_id`, 0),
+    c.`new_user_id` = coalesce(u.`new_id`, 0);
+
+alter table users
+  drop primary key,
+  drop column `id`,
+  change column `new_id` `id` bigint not null first,
+  modify column `legacy_id` varchar(50) null after `id`,
+  add primary key (`id`),
+  add unique key `idx_legacy_id` (`legacy_id`);
+alter table blogs
+  drop primary key,
+  drop column `id`,
+  drop column `user_id`,
+  change column `new_id` `id` bigint not null first,
+  modify column `legacy_id` varchar(50) null after `id`,
+  change column `new_user_id` `user_id` bigint not null after `legacy_id`,
+  add primary key (`id`),
+  add unique key `idx_legacy_id` (`legacy_id`);
+alter table comments
+  drop primary key,
+  drop column `id`,
+  drop column `blog_id`,
+  drop column `user_id`,
+  change column `new_id` `id` bigint not null first,
+  change column `new_blog_id` `blog_id` bigint not null after `id`,
+  change column `new_user_id` `user_id` bigint not null after `blog_id`,
+  add primary key (`id`);
+*/
+
+-- 已有数据库补充get_blog查询评论使用的索引：
+-- alter table comments add key `idx_blog_id_created_at` (`blog_id`, `created_at`);
+
+-- 已有数据库的blogs.content改为压缩存储（CompressedTextField）：先改列类型，再部署新代码，然后转换已有的数据
+-- alter table blogs modify column `content` mediumblob not null;
+-- python dbtool.py compress Blog content
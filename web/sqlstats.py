@@ -0,0 +1,303 @@
+"""
+SQL执行统计：按语句指纹汇总执行耗时、等待连接耗时和行数，超过阈值的语句记入慢查询日志
+track()统计一个请求内的语句，发现N+1（同一形状重复执行）和超出预算的请求
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import re
+
+slow_log = logging.getLogger("sql.slow")
+request_log = logging.getLogger("sql.requests")
+
+# 指纹缓存的最大条数，超过后清空重建
+_MAX_FINGERPRINTS = 4096
+
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_IN = re.compile(r"\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_RE_VALUES = re.compile(r"(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_RE_SPACE = re.compile(r"\s+")
+
+_slow_query_seconds = 0.2
+_shapes_file = None
+_fingerprints = {}
+_stats = {}
+_routes = {}
+# 当前请求的RequestQueries，由track()设置
+_tracker = contextvars.ContextVar("query_tracker", default=None)
+
+
+class QueryStat(object):
+    """同一指纹语句的累计统计"""
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def add(self, wait, elapsed, rows, failed):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.rows += rows
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        return dict(fingerprint=self.fingerprint, count=self.count, errors=self.errors, rows=self.rows,
+                    total_ms=self.total_time * 1000, avg_ms=self.total_time * 1000 / self.count,
+                    max_ms=self.max_time * 1000, wait_ms=self.total_wait * 1000, max_wait_ms=self.max_wait * 1000)
+
+    def __str__(self):
+        return f"<QueryStat {self.count}x {self.total_time * 1000:.1f}ms: {self.fingerprint}>"
+
+    __repr__ = __str__
+
+
+class QueryBudgetExceeded(Exception):
+    """track(strict=True)中的语句数、数据库耗时超出预算或出现N+1"""
+    pass
+
+
+class RequestQueries(object):
+    """一个请求（或一个track()块）内执行的语句，按指纹计数"""
+
+    def __init__(self, route=None):
+        self.route = route
+        self.count = 0
+        self.db_time = 0.0
+        self.shapes = {}
+
+    def add(self, fp, elapsed):
+        self.count += 1
+        self.db_time += elapsed
+        self.shapes[fp] = self.shapes.get(fp, 0) + 1
+
+    def repeated(self, threshold=5):
+        """ the fingerprints executed at least threshold times, most repeated first."""
+        return sorted(((fp, n) for fp, n in self.shapes.items() if n >= threshold), key=lambda i: i[1], reverse=True)
+
+    def problems(self, repeat_threshold=5, max_queries=0, max_db_ms=0):
+        problems = [f"{n}x {fp}" for fp, n in self.repeated(repeat_threshold)]
+        if max_queries and self.count > max_queries:
+            problems.append(f"{self.count} queries > budget {max_queries}")
+        if max_db_ms and self.db_time * 1000 > max_db_ms:
+            problems.append(f"{self.db_time * 1000:.1f}ms in database > budget {max_db_ms}ms")
+        return problems
+
+    def header(self, repeat_threshold=5):
+        """ the value of the X-Query-Stats response header."""
+        return f"queries={self.count}; db_ms={self.db_time * 1000:.1f}; repeated={len(self.repeated(repeat_threshold))}"
+
+    def __str__(self):
+        return f"<RequestQueries {self.route}: {self.count} queries, {self.db_time * 1000:.1f}ms>"
+
+    __repr__ = __str__
+
+
+class SharedQueries(object):
+    """
+    多个请求共同等待的任务（合并的查询、批量加载）中执行的语句，计入每个等待它的请求各一次
+    由share()在第一个请求中创建，之后加入的请求调用join()，任务开始时调用enter()
+    """
+
+    def __init__(self):
+        self.targets = []
+
+    def join(self):
+        """ count the statements of the shared task against the request of the current context too."""
+        queries = _tracker.get()
+        if queries is not None and queries is not self and queries not in self.targets:
+            self.targets.append(queries)
+
+    def enter(self):
+        """ count the statements executed from now on in the current (task) context against the joined requests."""
+        _tracker.set(self)
+
+    def add(self, fp, elapsed):
+        for queries in self.targets:
+            queries.add(fp, elapsed)
+
+
+class RouteStat(object):
+    """同一路由所有请求的累计统计"""
+
+    def __init__(self, route):
+        self.route = route
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.flagged = 0
+
+    def add(self, queries, flagged):
+        self.requests += 1
+        self.queries += queries.count
+        self.max_queries = max(self.max_queries, queries.count)
+        self.db_time += queries.db_time
+        if flagged:
+            self.flagged += 1
+
+    def as_dict(self):
+        return dict(route=self.route, requests=self.requests, queries=self.queries,
+                    avg_queries=self.queries / self.requests, max_queries=self.max_queries,
+                    db_ms=self.db_time * 1000, avg_db_ms=self.db_time * 1000 / self.requests, flagged=self.flagged)
+
+
+@contextlib.contextmanager
+def track(route=None, repeat_threshold=5, max_queries=0, max_db_ms=0, strict=False):
+    """
+    统计块内（包括块内创建的任务）执行的语句，正常退出时按路由汇总并记录日志：
+    有问题（N+1、超出预算）时记录警告，strict=True时抛出QueryBudgetExceeded，用于在测试中发现问题
+    """
+    queries = RequestQueries(route)
+    token = _tracker.set(queries)
+    try:
+        yield queries
+    except BaseException:
+        # 抛出异常的请求（如HTTPNotFound、重定向）同样计入，但不用QueryBudgetExceeded掩盖原来的异常
+        _tracker.reset(token)
+        _finish(queries, repeat_threshold, max_queries, max_db_ms)
+        raise
+    _tracker.reset(token)
+    summary, problems = _finish(queries, repeat_threshold, max_queries, max_db_ms)
+    if problems and strict:
+        raise QueryBudgetExceeded(f"{summary}: " + "; ".join(problems))
+
+
+def _finish(queries, repeat_threshold, max_queries, max_db_ms):
+    """ add a finished request to the stats of its route and log it, returning (summary, problems)."""
+    problems = queries.problems(repeat_threshold, max_queries, max_db_ms)
+    stat = _routes.get(queries.route)
+    if stat is None:
+        stat = _routes[queries.route] = RouteStat(queries.route)
+    stat.add(queries, bool(problems))
+    summary = f"{queries.route}: {queries.count} queries, {queries.db_time * 1000:.1f}ms in database"
+    if problems:
+        request_log.warning(f"{summary}\n  " + "\n  ".join(problems))
+    else:
+        request_log.info(summary)
+    return summary, problems
+
+
+def share():
+    """ a SharedQueries joined by the request of the current context, for a task several requests will wait on."""
+    shared = SharedQueries()
+    shared.join()
+    return shared
+
+
+def untrack():
+    """ stop counting the statements of the current context, for background tasks started inside a request."""
+    _tracker.set(None)
+
+
+def configure(slow_query_ms=200, shapes_file=None):
+    """
+    set the slow-query threshold in milliseconds, None or 0 turns the slow-query log off.
+    shapes_file collects one sample of every distinct select for dbtool.py advise.
+    """
+    global _slow_query_seconds, _shapes_file
+    _slow_query_seconds = slow_query_ms / 1000 if slow_query_ms else None
+    _shapes_file = shapes_file
+
+
+def fingerprint(sql):
+    """
+    归一化语句：去掉字面量，合并IN列表和多行VALUES，统一空白和大小写
+    如 select * from t where id in (?, ?, ?) and name='a' ==> select * from t where id in (...) and name=?
+    """
+    fp = _fingerprints.get(sql)
+    if fp is None:
+        fp = sql.replace("%s", "?")
+        fp = _RE_STRING.sub("?", fp)
+        fp = _RE_NUMBER.sub("?", fp)
+        fp = _RE_IN.sub("in (...)", fp)
+        fp = _RE_VALUES.sub(r"\1, ...", fp)
+        fp = _RE_SPACE.sub(" ", fp).strip().lower()
+        if len(_fingerprints) >= _MAX_FINGERPRINTS:
+            _fingerprints.clear()
+        _fingerprints[sql] = fp
+    return fp
+
+
+def redact(args):
+    """ describe args by type and size only, so slow-query logs never contain user data."""
+    if not args:
+        return "[]"
+    return "[" + ", ".join(
+        f"<{type(a).__name__}:{len(a)}>" if isinstance(a, (str, bytes)) else f"<{type(a).__name__}>"
+        for a in args) + "]"
+
+
+def record(sql, args, wait, elapsed, rows, failed=False):
+    """
+    记录一次语句执行
+    :param wait: 等待连接池（或固定连接的锁）的秒数
+    :param elapsed: 执行耗时秒数
+    :param rows: 返回或影响的行数
+    """
+    fp = fingerprint(sql)
+    stat = _stats.get(fp)
+    if stat is None:
+        stat = _stats[fp] = QueryStat(fp)
+        if _shapes_file is not None and fp.startswith("select"):
+            save_shape(fp, sql, args)
+    stat.add(wait, elapsed, rows, failed)
+    queries = _tracker.get()
+    if queries is not None:
+        queries.add(fp, elapsed)
+    if _slow_query_seconds is not None and elapsed >= _slow_query_seconds:
+        slow_log.warning(f"Slow query {elapsed * 1000:.1f}ms (wait {wait * 1000:.1f}ms, rows {rows}): {fp} "
+                         f"args: {redact(args)}")
+    return stat
+
+
+def save_shape(fp, sql, args):
+    """
+    追加一行{"fingerprint", "sql", "args"}到shapes_file，每个进程每种语句一次
+    args是实际的参数，EXPLAIN需要它们选择执行计划，因此只应在开发和测试环境中启用
+    """
+    try:
+        with open(_shapes_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(dict(fingerprint=fp, sql=sql, args=list(args or ())), ensure_ascii=False,
+                               default=str) + "\n")
+    except OSError as e:
+        logging.warning(f"Failed to save query shape to {_shapes_file}: {e}")
+
+
+def load_shapes(path):
+    """ the samples saved to a shapes file, one per fingerprint."""
+    shapes = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                shape = json.loads(line)
+                shapes.setdefault(shape["fingerprint"], shape)
+    return list(shapes.values())
+
+
+def stats(order_by="total_ms", limit=None):
+    """ the per-fingerprint aggregates as dicts, most expensive first."""
+    rs = sorted((s.as_dict() for s in _stats.values()), key=lambda d: d[order_by], reverse=True)
+    return rs[:limit] if limit else rs
+
+
+def route_stats(order_by="queries", limit=None):
+    """ the per-route aggregates of tracked requests as dicts, most queries first."""
+    rs = sorted((s.as_dict() for s in _routes.values()), key=lambda d: d[order_by], reverse=True)
+    return rs[:limit] if limit else rs
+
+
+def reset():
+    _stats.clear()
+    _routes.clear()